@@ -0,0 +1,389 @@
+import io
+import os
+import shutil
+import sqlite3
+import tarfile
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .codec import dumps, loads
+
+# never: leave it to the OS, snapshot: fsync snapshots, always: fsync
+# snapshots and journal appends
+FSYNC_POLICIES = ["never", "snapshot", "always"]
+
+
+def parse_journal(lines) -> List[dict]:
+    entries = []
+    for line in lines:
+        try:
+            entries.append(loads(line))
+        except ValueError:
+            # torn write at the end of the journal
+            break
+    return entries
+
+
+def write_archive(fn: Path, members: Dict[str, bytes]):
+    """one gzipped tar file, replaced in one step"""
+    fn.parent.mkdir(exist_ok=True, parents=True)
+    tmp = fn.with_name(fn.name + ".tmp")
+    with tarfile.open(tmp, "w:gz") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    os.replace(tmp, fn)
+
+
+def read_archive(fn: Path) -> Dict[str, bytes]:
+    with tarfile.open(fn, "r:gz") as tar:
+        return {
+            member.name: tar.extractfile(member).read()
+            for member in tar.getmembers()
+            if member.isfile()
+        }
+
+
+def fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FilesystemBackend:
+    """one directory per game: {ts}.json (or .bin) snapshots, default.json
+    symlink to the current one and journal.jsonl; positions are byte
+    offsets
+
+    All methods block; the store runs them in its I/O thread.
+    """
+
+    def __init__(self, path: Path, fsync="never"):
+        self.path = path
+        self.fsync = FSYNC_POLICIES.index(fsync)
+
+    def exists(self, name) -> bool:
+        return (self.path / name / "default.json").exists()
+
+    def scan(self) -> Iterator[Tuple[str, bytes, float]]:
+        for fn in self.path.glob("*/default.json"):
+            yield fn.parent.name, fn.read_bytes(), fn.stat().st_mtime
+
+    def write_snapshot(self, name, data: bytes, ts, compact=False, suffix=".json"):
+        _path = self.path / name
+        _path.mkdir(exist_ok=True, parents=True)
+
+        fn = _path / f"{ts}{suffix}"
+        with open(fn, "wb") as fp:
+            fp.write(data)
+            if self.fsync:
+                os.fsync(fp.fileno())
+
+        # symlink to current version; replace the link in one step, so
+        # readers never see a missing default.json
+        _link = _path / "default.json"
+        previous = _link.resolve() if compact and _link.is_symlink() else None
+        _tmp = _path / "default.json.tmp"
+        _tmp.unlink(missing_ok=True)
+        _tmp.symlink_to(fn.name)
+        os.replace(_tmp, _link)
+        if self.fsync:
+            fsync_dir(_path)
+        if previous and previous != fn.resolve():
+            # older snapshot is compacted into the new one
+            previous.unlink(missing_ok=True)
+
+    def read_snapshot(self, name) -> Optional[bytes]:
+        fn = self.path / name / "default.json"
+        try:
+            return fn.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def append_journal(self, name, entries: List[dict]):
+        _path = self.path / name
+        _path.mkdir(exist_ok=True, parents=True)
+        lines = [dumps(e) + b"\n" for e in entries]
+        with open(_path / "journal.jsonl", "ab") as fp:
+            start = fp.tell()
+            fp.write(b"".join(lines))
+            if self.fsync > 1:
+                os.fsync(fp.fileno())
+        if self.index_end(name) == start:
+            ends = array("Q")
+            for line in lines:
+                start += len(line)
+                ends.append(start)
+            with open(_path / "journal.idx", "ab") as fp:
+                fp.write(ends.tobytes())
+
+    def index_end(self, name) -> int:
+        """journal offset covered by journal.idx, which holds the end
+        offset of every entry as 8 byte integers"""
+        try:
+            with open(self.path / name / "journal.idx", "rb") as fp:
+                fp.seek(-8, os.SEEK_END)
+                return array("Q", fp.read(8))[0]
+        except OSError:
+            # missing or empty
+            return 0
+
+    def sync_index(self, name) -> int:
+        """index the entries appended without it, e.g. before the index
+        existed; returns the number of entries"""
+        _path = self.path / name
+        end = self.index_end(name)
+        journal = _path / "journal.jsonl"
+        if not journal.exists():
+            return 0
+        if journal.stat().st_size > end:
+            with open(journal, "rb") as fp:
+                fp.seek(end)
+                ends = array("Q")
+                for line in fp:
+                    if not line.endswith(b"\n"):
+                        # torn write
+                        break
+                    end += len(line)
+                    ends.append(end)
+            with open(_path / "journal.idx", "ab") as fp:
+                fp.write(ends.tobytes())
+        return (_path / "journal.idx").stat().st_size // 8
+
+    def history(self, name, start=0, limit=100) -> Tuple[int, List[dict]]:
+        """total number of journal entries and entries [start, start + limit),
+        read through the index"""
+        total = self.sync_index(name)
+        if start >= total or limit <= 0:
+            return total, []
+        stop = min(start + limit, total)
+        _path = self.path / name
+        with open(_path / "journal.idx", "rb") as fp:
+            # end of the entry before start, up to the end of the last one
+            first = max(start - 1, 0)
+            fp.seek(first * 8)
+            ends = array("Q", fp.read((stop - first) * 8))
+        begin = ends[0] if start else 0
+        with open(_path / "journal.jsonl", "rb") as fp:
+            fp.seek(begin)
+            data = fp.read(ends[-1] - begin)
+        return total, parse_journal(data.splitlines())
+
+    def journal_position(self, name) -> int:
+        fn = self.path / name / "journal.jsonl"
+        return fn.stat().st_size if fn.exists() else 0
+
+    def read_journal(self, name, position=0) -> List[dict]:
+        fn = self.path / name / "journal.jsonl"
+        if not fn.exists():
+            return []
+        with open(fn, "rb") as fp:
+            fp.seek(position)
+            return parse_journal(fp.read().splitlines())
+
+    def stamp(self, name):
+        """changes whenever another process saved the game"""
+        _path = self.path / name
+        try:
+            return os.readlink(_path / "default.json"), self.journal_position(name)
+        except OSError:
+            return None
+
+    @staticmethod
+    def current(_path: Path) -> str:
+        """file name of the current snapshot; older versions linked to an
+        absolute path"""
+        return Path(os.readlink(_path / "default.json")).name
+
+    def prune(self, name, keep=1) -> int:
+        """delete all but the newest `keep` snapshots, the current one
+        included; returns the number of deleted files"""
+        _path = self.path / name
+        try:
+            current = self.current(_path)
+        except OSError:
+            return 0
+        snapshots = []
+        for fn in _path.iterdir():
+            if fn.suffix in (".json", ".bin") and fn.name not in (
+                current,
+                "default.json",
+            ):
+                try:
+                    snapshots.append((float(fn.stem), fn))
+                except ValueError:
+                    continue
+        snapshots.sort(reverse=True)
+        stale = snapshots[max(keep - 1, 0) :]
+        for _, fn in stale:
+            fn.unlink(missing_ok=True)
+        return len(stale)
+
+    def dump(self, name) -> Optional[Dict[str, bytes]]:
+        """current snapshot and journal, for the archive"""
+        _path = self.path / name
+        try:
+            current = self.current(_path)
+            snapshot = (_path / current).read_bytes()
+        except OSError:
+            return None
+        journal = _path / "journal.jsonl"
+        return {
+            "snapshot": snapshot,
+            "snapshot.name": current.encode(),
+            "journal": journal.read_bytes() if journal.exists() else b"",
+        }
+
+    def restore(self, name, members: Dict[str, bytes]):
+        _path = self.path / name
+        _path.mkdir(exist_ok=True, parents=True)
+        current = members["snapshot.name"].decode()
+        (_path / current).write_bytes(members["snapshot"])
+        if members["journal"]:
+            # byte for byte, the snapshot refers to offsets in it
+            (_path / "journal.jsonl").write_bytes(members["journal"])
+        _tmp = _path / "default.json.tmp"
+        _tmp.unlink(missing_ok=True)
+        _tmp.symlink_to(current)
+        os.replace(_tmp, _path / "default.json")
+
+    def delete(self, name):
+        shutil.rmtree(self.path / name, ignore_errors=True)
+
+
+class SQLiteBackend:
+    """all games in one SQLite database in WAL mode, so several worker
+    processes can read and write concurrently; positions are journal
+    sequence numbers"""
+
+    # PRAGMA synchronous per fsync policy; in WAL mode NORMAL only syncs
+    # on checkpoints, OFF could corrupt the database on power loss
+    SYNCHRONOUS = {"never": "NORMAL", "snapshot": "NORMAL", "always": "FULL"}
+
+    def __init__(self, path: Path, fsync="never"):
+        self.path = path
+        path.mkdir(exist_ok=True, parents=True)
+        self.db = sqlite3.connect(
+            path / "store.sqlite3", timeout=10, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"PRAGMA synchronous={self.SYNCHRONOUS[fsync]}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots "
+            "(name TEXT PRIMARY KEY, data BLOB, modified REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS journal "
+            "(name TEXT, seq INTEGER, entry BLOB, PRIMARY KEY (name, seq))"
+        )
+        self.db.commit()
+
+    def exists(self, name) -> bool:
+        row = self.db.execute("SELECT 1 FROM snapshots WHERE name = ?", (name,))
+        return row.fetchone() is not None
+
+    def scan(self) -> Iterator[Tuple[str, bytes, float]]:
+        yield from self.db.execute("SELECT * FROM snapshots")
+
+    def write_snapshot(self, name, data: bytes, ts, compact=False, suffix=".json"):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                (name, data, ts),
+            )
+
+    def read_snapshot(self, name) -> Optional[bytes]:
+        row = self.db.execute(
+            "SELECT data FROM snapshots WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def append_journal(self, name, entries: List[dict]):
+        with self.db:
+            start = self.journal_position(name)
+            self.db.executemany(
+                "INSERT INTO journal VALUES (?, ?, ?)",
+                [(name, start + i + 1, dumps(e)) for i, e in enumerate(entries)],
+            )
+            self.db.execute(
+                "UPDATE snapshots SET modified = ? WHERE name = ?",
+                (entries[-1].get("ts"), name),
+            )
+
+    def journal_position(self, name) -> int:
+        row = self.db.execute(
+            "SELECT max(seq) FROM journal WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] or 0
+
+    def read_journal(self, name, position=0) -> List[dict]:
+        rows = self.db.execute(
+            "SELECT entry FROM journal WHERE name = ? AND seq > ? ORDER BY seq",
+            (name, position),
+        )
+        return parse_journal(row[0] for row in rows)
+
+    def stamp(self, name):
+        return self.db.execute(
+            "SELECT modified, (SELECT max(seq) FROM journal WHERE name = ?) "
+            "FROM snapshots WHERE name = ?",
+            (name, name),
+        ).fetchone()
+
+    def history(self, name, start=0, limit=100) -> Tuple[int, List[dict]]:
+        rows = self.db.execute(
+            "SELECT entry FROM journal WHERE name = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (name, start, max(limit, 0)),
+        )
+        return self.journal_position(name), parse_journal(row[0] for row in rows)
+
+    def prune(self, name, keep=1) -> int:
+        # one snapshot row per game
+        return 0
+
+    def dump(self, name) -> Optional[Dict[str, bytes]]:
+        row = self.db.execute(
+            "SELECT data, modified FROM snapshots WHERE name = ?", (name,)
+        ).fetchone()
+        if not row:
+            return None
+        entries = self.db.execute(
+            "SELECT entry FROM journal WHERE name = ? ORDER BY seq", (name,)
+        )
+        return {
+            "snapshot": row[0],
+            "modified": repr(row[1] or 0.0).encode(),
+            "journal": b"\n".join(
+                e if isinstance(e, bytes) else e.encode() for (e,) in entries
+            ),
+        }
+
+    def restore(self, name, members: Dict[str, bytes]):
+        lines = members["journal"].splitlines()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                (name, members["snapshot"], float(members["modified"])),
+            )
+            # sequence numbers start at 1, as when they were written
+            self.db.executemany(
+                "INSERT OR REPLACE INTO journal VALUES (?, ?, ?)",
+                [(name, i + 1, line) for i, line in enumerate(lines)],
+            )
+
+    def delete(self, name):
+        with self.db:
+            self.db.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+            self.db.execute("DELETE FROM journal WHERE name = ?", (name,))
+
+
+BACKENDS = {
+    "filesystem": FilesystemBackend,
+    "sqlite": SQLiteBackend,
+}
@@ -0,0 +1,295 @@
+"""Benchmarks for the engine, store, rendering and broadcast hot paths.
+
+    python -m app.benchmark --out new.json --compare old.json
+
+Results are written as JSON (median/min microseconds per operation), a
+comparison flags every benchmark that got slower than --threshold.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from .codec import CODECS, decode
+from .games.maumau import MauMau
+from .games.simulate import random_policy
+from .models import Game
+from .store import Store
+from .utils import WebsocketConnectionManager, gen_templates
+
+PLAYERS = [2, 3, 4, 5, 6]
+
+
+def seeded_game(players: int, seed: int, moves: int = 10) -> MauMau:
+    """game with `players` players, `moves` random moves into the game"""
+    random.seed(seed)
+    game = MauMau(f"bench-{seed}", [f"p{i}" for i in range(players)])
+    for _ in range(moves):
+        if game.check_win():
+            break
+        player_id = game.current_player
+        game.action(player_id, *random_policy(game, player_id))
+    return game
+
+
+def measure(func, number, repeat):
+    """median and min microseconds per call of func"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number * 1e6)
+    return {
+        "number": number,
+        "median_us": round(statistics.median(timings), 3),
+        "min_us": round(min(timings), 3),
+    }
+
+
+def bench_engine(results, number, repeat):
+    for players in PLAYERS:
+        games = [seeded_game(players, seed, moves=0) for seed in range(number)]
+        snapshots = [g.serialize() for g in games]
+
+        def play():
+            # one full game per call, restored from the snapshot
+            i = random.randrange(number)
+            g = games[i]
+            g.load(snapshots[i])
+            for _ in range(200):
+                if g.check_win():
+                    break
+                g.action(g.current_player, *random_policy(g, g.current_player))
+
+        random.seed(0)
+        results[f"engine_game_{players}p"] = measure(play, number, repeat)
+
+        game = seeded_game(players, 1)
+
+        def status():
+            game.version += 1
+            game.status("p0")
+
+        results[f"engine_status_{players}p"] = measure(status, number * 10, repeat)
+
+
+def bench_store(results, number, repeat, games=300):
+    loop = asyncio.new_event_loop()
+    with tempfile.TemporaryDirectory() as path:
+        store = Store(path=path, journal=True)
+        names = [f"game-{i}" for i in range(games)]
+        fixtures = {}
+        for i, name in enumerate(names):
+            players = [f"p{i}" for i in range(PLAYERS[i % 5])]
+            game = Game(name=name, players=players, kind="maumau", host="p0")
+            game.instance = seeded_game(len(game.players), i)
+            fixtures[name] = game
+            loop.run_until_complete(store.save(name, game))
+
+        def save():
+            name = random.choice(names)
+            game = fixtures[name]
+            player_id = game.instance.current_player
+            game.instance.action(player_id, *random_policy(game.instance, player_id))
+            loop.run_until_complete(store.save(name, game))
+
+        def load():
+            # cold cache, read snapshot and journal from disk
+            store.game_states.data.clear()
+            loop.run_until_complete(store.load(random.choice(names)))
+
+        random.seed(0)
+        results["store_save_journal"] = measure(save, number, repeat)
+        results["store_load"] = measure(load, number, repeat)
+
+        store.journal = False
+        results["store_save_snapshot"] = measure(save, number, repeat)
+
+        # save returns before the write, the flush is measured on its own
+        store.journal = True
+        store.write_behind = 60
+        results["store_save_write_behind"] = measure(save, number, repeat)
+
+        def burst():
+            # ten saves coalesced into one batch
+            for _ in range(10):
+                save()
+            loop.run_until_complete(store.flush())
+
+        results["store_flush_10_saves"] = measure(burst, max(1, number // 10), repeat)
+        loop.run_until_complete(store.close())
+    loop.close()
+
+
+def bench_codec(results, number, repeat):
+    game = Game(
+        name="bench", players=["p0", "p1", "p2", "p3"], kind="maumau", host="p0"
+    )
+    game.instance = seeded_game(4, 1)
+    game.modified = time.time()
+    # snapshot as written before records were versioned
+    legacy = json.dumps(
+        {
+            "name": game.name,
+            "players": game.players,
+            "kind": "maumau",
+            "host": game.host,
+            "state": game.instance.serialize(),
+            "instance": None,
+            "modified": game.modified,
+        }
+    ).encode()
+    for name, codec in CODECS.items():
+        data = codec.encode(game, 0)
+        results[f"codec_encode_{name}"] = measure(
+            lambda: codec.encode(game, 0), number * 10, repeat
+        )
+        results[f"codec_decode_{name}"] = dict(
+            measure(lambda: decode(data), number * 10, repeat), bytes=len(data)
+        )
+    results["codec_decode_legacy"] = dict(
+        measure(lambda: decode(legacy), number * 10, repeat), bytes=len(legacy)
+    )
+
+
+def bench_render(results, number, repeat):
+    templates = gen_templates()
+    status = templates.env.get_template("partials/status.html")
+    action_area = templates.env.get_template("partials/action_area.html")
+    for players in [2, 6]:
+        game = seeded_game(players, 1)
+        results[f"render_status_{players}p"] = measure(
+            lambda: status.render(state=game.status()), number, repeat
+        )
+        results[f"render_action_area_{players}p"] = measure(
+            lambda: action_area.render(
+                user_id="p0", state=game.status("p0"), name="bench", msg=""
+            ),
+            number,
+            repeat,
+        )
+
+
+class FakeWebsocket:
+    def __init__(self):
+        self.received = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        self.received += 1
+
+    async def close(self):
+        pass
+
+
+def bench_broadcast(results, number, repeat):
+    loop = asyncio.new_event_loop()
+    for clients in [1, 10, 100]:
+        manager = WebsocketConnectionManager(queue_size=number + 1)
+        sockets = [FakeWebsocket() for _ in range(clients)]
+        for ws in sockets:
+            loop.run_until_complete(manager.connect(ws, "bench"))
+
+        async def fan_out():
+            await manager.broadcast("<div>state</div>", "bench")
+            # until every client got the frame
+            while any(c.queue.qsize() for c in manager.active_connections["bench"]):
+                await asyncio.sleep(0)
+
+        results[f"broadcast_{clients}_clients"] = measure(
+            lambda: loop.run_until_complete(fan_out()), number, repeat
+        )
+
+        async def close():
+            tasks = [t for c in manager.active_connections["bench"] for t in c.tasks]
+            for ws in sockets:
+                manager.disconnect(ws, "bench")
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        loop.run_until_complete(close())
+    loop.close()
+
+
+BENCHMARKS = {
+    "engine": bench_engine,
+    "store": bench_store,
+    "codec": bench_codec,
+    "render": bench_render,
+    "broadcast": bench_broadcast,
+}
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """benchmarks where new median / old median exceeds threshold"""
+    regressions = {}
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before and before["median_us"]:
+            ratio = result["median_us"] / before["median_us"]
+            if ratio > threshold:
+                regressions[name] = round(ratio, 3)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", help="write results as json")
+    parser.add_argument("--compare", help="results json of the baseline revision")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", choices=BENCHMARKS, action="append")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"running {name}", file=sys.stderr)
+        BENCHMARKS[name](results, args.number, args.repeat)
+
+    data = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "number": args.number,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    for name, result in results.items():
+        print(f"{name:32} {result['median_us']:12.1f} us", file=sys.stderr)
+    if args.out:
+        with open(args.out, "w") as fp:
+            json.dump(data, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(json.load(fp), data, args.threshold)
+        for name, ratio in regressions.items():
+            print(f"regression: {name} is {ratio}x slower", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
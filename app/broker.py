@@ -0,0 +1,140 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# longest line, i.e. rendered fragment, relayed between workers
+LIMIT = 2**22
+
+
+class Broker:
+    """Relays broadcasts between worker processes over a unix socket.
+
+    The first worker that binds the socket relays every published line to
+    all other connected workers; every worker, including that one,
+    connects as a client. If the relaying worker goes away, the clients
+    reconnect and one of them takes over; a lock file held by the relay
+    makes sure there is only one.
+    """
+
+    def __init__(self, path: str, deliver: Callable[..., Awaitable[None]]):
+        self.path = path
+        self.deliver = deliver
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.peers: List[asyncio.StreamWriter] = []
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+        self.lockfile = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+        if self.server:
+            self.server.close()
+            for peer in list(self.peers):
+                peer.close()
+            await asyncio.sleep(0)
+        if self.lockfile:
+            # let another worker take over the relay
+            self.lockfile.close()
+
+    async def publish(
+        self,
+        game: str,
+        message: str,
+        version: Optional[int] = None,
+        delta: Optional[str] = None,
+        base: Optional[int] = None,
+        user_id: Optional[str] = None,
+    ):
+        if self.writer is None:
+            return
+        line = json.dumps(
+            {
+                "game": game,
+                "message": message,
+                "version": version,
+                "delta": delta,
+                "base": base,
+                "user_id": user_id,
+            }
+        )
+        try:
+            self.writer.write(line.encode() + b"\n")
+            await self.writer.drain()
+        except (ConnectionError, RuntimeError):
+            self.writer = None
+
+    async def run(self):
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(
+                    self.path, limit=LIMIT
+                )
+            except (ConnectionRefusedError, FileNotFoundError):
+                await self.serve()
+                continue
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    data = json.loads(line)
+                    await self.deliver(
+                        data["message"],
+                        data["game"],
+                        data["version"],
+                        data["delta"],
+                        data["base"],
+                        data.get("user_id"),
+                    )
+            except (ConnectionError, ValueError) as e:
+                logger.warning("broker connection lost: %s", e)
+            self.writer = None
+            await asyncio.sleep(0.1)
+
+    async def serve(self):
+        """become the relay, unless another worker already is"""
+        if self.lockfile is None:
+            self.lockfile = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # the relay is starting up
+            await asyncio.sleep(0.1)
+            return
+        if self.server is None:
+            if os.path.exists(self.path):
+                # left over from a dead relay
+                os.unlink(self.path)
+            self.server = await asyncio.start_unix_server(
+                self.relay, self.path, limit=LIMIT
+            )
+
+    async def relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.peers.append(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for peer in self.peers:
+                    if peer is not writer:
+                        try:
+                            peer.write(line)
+                        except (ConnectionError, RuntimeError):
+                            pass
+        except ConnectionError:
+            pass
+        finally:
+            self.peers.remove(writer)
+            writer.close()
@@ -0,0 +1,249 @@
+"""Static assets, built once and served with content hashed urls.
+
+The card images are combined into one svg sprite, one <symbol> per card,
+so a game page loads a single image however many cards it shows. The
+sprite, the stylesheet and the scripts are written to app/build/ under
+names containing a hash of their content, with gzip (and brotli, when
+installed) variants next to them. A rebuild only happens when a source
+file changed.
+
+The hashed urls never change their content: they are served with an
+immutable Cache-Control header, an ETag and 304 responses.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = Path(__file__).parent
+BUILD = ROOT / "build"
+# bump when the output changes for the same sources
+VERSION = 1
+
+# output name -> source files, relative to app/
+SOURCES: Dict[str, List[str]] = {
+    "cards.svg": sorted(
+        str(p.relative_to(ROOT)) for p in (ROOT / "assets" / "white").glob("*.svg")
+    )
+    + ["assets/backs/back08.svg"],
+    "bulma.min.css": ["static/bulma.min.css"],
+    "htmx.min.js": ["static/htmx.min.js"],
+    "ws.js": ["static/ws.js"],
+}
+
+SVG = "http://www.w3.org/2000/svg"
+XLINK = "http://www.w3.org/1999/xlink"
+# editor and license metadata, not needed to draw a card
+DROPPED = {
+    "http://inkscape.sourceforge.net/DTD/sodipodi-0.dtd",
+    "http://www.inkscape.org/namespaces/inkscape",
+    "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "http://purl.org/dc/elements/1.1/",
+    "http://web.resource.org/cc/",
+}
+REFERENCE = re.compile(r"url\(#([^)]+)\)")
+
+# a year, the longest browsers keep anything
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+ENCODINGS = ["br", "gzip"]
+
+
+def namespace(name: str) -> str:
+    return name[1:].split("}")[0] if name.startswith("{") else ""
+
+
+def symbol(fn: Path) -> Tuple[ET.Element, List[ET.Element]]:
+    """a card image as a <symbol> with the id of its file name, and its
+    <defs>; element ids get the same prefix, so cards do not clash"""
+    prefix = fn.stem
+    root = ET.parse(fn).getroot()
+
+    def strip(element):
+        for child in list(element):
+            if namespace(child.tag) in DROPPED or child.tag == f"{{{SVG}}}metadata":
+                element.remove(child)
+            else:
+                strip(child)
+        for key, value in list(element.attrib.items()):
+            if namespace(key) in DROPPED:
+                del element.attrib[key]
+            elif key == "id":
+                element.set(key, f"{prefix}-{value}")
+            elif key == f"{{{XLINK}}}href" and value.startswith("#"):
+                element.set(key, f"#{prefix}-{value[1:]}")
+            elif "url(#" in value:
+                element.set(key, REFERENCE.sub(rf"url(#{prefix}-\1)", value))
+
+    strip(root)
+    width = float(root.get("width", 140))
+    height = float(root.get("height", 190))
+    result = ET.Element(
+        f"{{{SVG}}}symbol",
+        id=prefix,
+        viewBox=root.get("viewBox", f"0 0 {width:g} {height:g}"),
+    )
+    defs = []
+    for child in root:
+        if child.tag == f"{{{SVG}}}defs":
+            defs.extend(child)
+        else:
+            result.append(child)
+    return result, defs
+
+
+def sprite(files: Iterable[Path]) -> bytes:
+    """svg with one symbol per file, the defs of all of them up front;
+    gradients referenced from an external <use> render more reliably
+    outside of the symbols"""
+    ET.register_namespace("", SVG)
+    ET.register_namespace("xlink", XLINK)
+    root = ET.Element(f"{{{SVG}}}svg")
+    defs = ET.SubElement(root, f"{{{SVG}}}defs")
+    for fn in files:
+        element, _defs = symbol(fn)
+        defs.extend(_defs)
+        root.append(element)
+
+    # only ids that are referenced, and the symbols
+    used = set()
+    for element in root.iter():
+        for key, value in element.attrib.items():
+            if key == f"{{{XLINK}}}href" and value.startswith("#"):
+                used.add(value[1:])
+            used.update(REFERENCE.findall(value))
+    for element in root.iter():
+        if element.get("id") not in used and element.tag != f"{{{SVG}}}symbol":
+            element.attrib.pop("id", None)
+
+    data = ET.tostring(root)
+    # inkscape indents with spaces and writes 1.0000000
+    data = re.sub(rb">\s+<", b"><", data)
+    data = re.sub(rb"(\.\d*?[1-9])0+\b", rb"\1", data)
+    return re.sub(rb"(\d)\.0+\b", rb"\1", data)
+
+
+def hashed_name(name: str, data: bytes) -> str:
+    stem, _, suffix = name.rpartition(".")
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{suffix}"
+
+
+def write(fn: Path, data: bytes):
+    # several workers may build at the same time
+    tmp = fn.with_name(f"{fn.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, fn)
+
+
+def build(
+    dest: Path = BUILD, sources: Dict[str, List[str]] = SOURCES
+) -> Dict[str, str]:
+    """build what changed; returns the hashed name per output name"""
+    digest = hashlib.sha256(str(VERSION).encode())
+    for name, files in sorted(sources.items()):
+        for fn in files:
+            digest.update(fn.encode() + b"\0" + (ROOT / fn).read_bytes())
+    source = digest.hexdigest()
+
+    manifest_fn = dest / "manifest.json"
+    try:
+        manifest = json.loads(manifest_fn.read_text())
+        if manifest["source"] == source and manifest["brotli"] == bool(brotli):
+            return manifest["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    dest.mkdir(exist_ok=True, parents=True)
+    files = {}
+    for name, inputs in sources.items():
+        if name.endswith(".svg") and len(inputs) > 1:
+            data = sprite(ROOT / fn for fn in inputs)
+        else:
+            data = (ROOT / inputs[0]).read_bytes()
+        files[name] = hashed_name(name, data)
+        write(dest / files[name], data)
+        write(dest / f"{files[name]}.gz", gzip.compress(data, 9, mtime=0))
+        if brotli:
+            write(dest / f"{files[name]}.br", brotli.compress(data))
+    manifest = {"source": source, "brotli": bool(brotli), "files": files}
+    write(manifest_fn, json.dumps(manifest, indent=2).encode())
+    return files
+
+
+class Asset:
+    __slots__ = ("content_type", "etag", "variants")
+
+    def __init__(self, fn: Path):
+        self.content_type = mimetypes.guess_type(fn.name)[0] or "text/plain"
+        # the content hash from the name
+        self.etag = fn.name.split(".")[-2]
+        self.variants: Dict[str, bytes] = {"": fn.read_bytes()}
+        for encoding, suffix in [("br", ".br"), ("gzip", ".gz")]:
+            variant = fn.with_name(fn.name + suffix)
+            if variant.exists():
+                self.variants[encoding] = variant.read_bytes()
+
+
+def accepted(header: str) -> List[str]:
+    """encodings from an Accept-Encoding header, without q=0 ones"""
+    result = []
+    for part in header.split(","):
+        encoding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            result.append(encoding.strip().lower())
+    return result
+
+
+class Assets:
+    """the built files, kept in memory"""
+
+    def __init__(self, dest: Path = BUILD):
+        self.files = build(dest)
+        self.assets = {hashed: Asset(dest / hashed) for hashed in self.files.values()}
+
+    def url(self, name: str) -> str:
+        return f"/build/{self.files[name]}"
+
+    def lookup(
+        self, name: str, accept_encoding: str = "", if_none_match: str = ""
+    ) -> Optional[Tuple[int, Dict[str, str], bytes]]:
+        """status, headers and body for a request, None if unknown"""
+        asset = self.assets.get(name)
+        if asset is None:
+            return None
+        encoding = ""
+        encodings = accepted(accept_encoding)
+        for candidate in ENCODINGS:
+            if candidate in asset.variants and candidate in encodings:
+                encoding = candidate
+                break
+        etag = f'"{asset.etag}-{encoding}"' if encoding else f'"{asset.etag}"'
+        headers = {
+            "cache-control": CACHE_CONTROL,
+            "etag": etag,
+            "vary": "Accept-Encoding",
+        }
+        tags = [t.strip() for t in if_none_match.split(",")]
+        if etag in tags or f"W/{etag}" in tags or "*" in tags:
+            return 304, headers, b""
+        headers["content-type"] = asset.content_type
+        if encoding:
+            headers["content-encoding"] = encoding
+        return 200, headers, asset.variants[encoding]
+
+
+@lru_cache(maxsize=None)
+def assets() -> Assets:
+    """built on first use, once per process"""
+    return Assets()
@@ -0,0 +1,111 @@
+import sqlite3
+
+STATUS = {
+    "open": "started = 0",
+    "started": "started = 1 AND finished = 0",
+    "finished": "finished = 1",
+}
+
+
+class Catalogue:
+    """Index of all stored games for the lobby, updated by Store.save."""
+
+    def __init__(self, fn):
+        fn.parent.mkdir(exist_ok=True, parents=True)
+        # several workers may update the catalogue
+        self.db = sqlite3.connect(fn, timeout=10, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS games ("
+            "name TEXT PRIMARY KEY, kind TEXT, host TEXT, players INTEGER, "
+            "started INTEGER, finished INTEGER, modified REAL, "
+            "archived INTEGER DEFAULT 0)"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(games)")]
+        if "archived" not in columns:
+            # catalogue of an older version
+            self.db.execute("ALTER TABLE games ADD COLUMN archived INTEGER DEFAULT 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS games_modified ON games (modified)")
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM games").fetchone()[0]
+
+    def __contains__(self, name):
+        row = self.db.execute("SELECT 1 FROM games WHERE name = ?", (name,))
+        return row.fetchone() is not None
+
+    def names(self):
+        return [row[0] for row in self.db.execute("SELECT name FROM games")]
+
+    def update(self, name, kind, host, players, started, finished, modified):
+        self.update_many([(name, kind, host, players, started, finished, modified)])
+
+    def query(self, status=None, offset=0, limit=50, recent=True):
+        where = f"WHERE {STATUS[status]}" if status in STATUS else ""
+        order = "DESC" if recent else "ASC"
+        rows = self.db.execute(
+            f"SELECT * FROM games {where} ORDER BY modified {order} LIMIT ? OFFSET ?",
+            (limit, offset),
+        )
+        return [dict(row) for row in rows]
+
+    def count(self, status=None):
+        where = f"WHERE {STATUS[status]}" if status in STATUS else ""
+        return self.db.execute(f"SELECT count(*) FROM games {where}").fetchone()[0]
+
+    def modified(self, name):
+        row = self.db.execute("SELECT modified FROM games WHERE name = ?", (name,))
+        result = row.fetchone()
+        return result[0] if result else None
+
+    def version(self):
+        """changes whenever a game is added or saved"""
+        return self.db.execute("SELECT max(modified) FROM games").fetchone()[0]
+
+    def update_many(self, rows):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO games "
+                "(name, kind, host, players, started, finished, modified) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def set_archived(self, name, archived=True):
+        with self.db:
+            self.db.execute(
+                "UPDATE games SET archived = ? WHERE name = ?", (archived, name)
+            )
+
+    def modified_since(self, ts):
+        rows = self.db.execute("SELECT name FROM games WHERE modified >= ?", (ts,))
+        return [row[0] for row in rows]
+
+    def archivable(self, finished_before, idle_before):
+        """games finished or last modified before the given timestamps"""
+        rows = self.db.execute(
+            "SELECT name FROM games WHERE archived = 0 AND "
+            "((finished = 1 AND modified < ?) OR modified < ?)",
+            (finished_before, idle_before),
+        )
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def row(name, game, modified):
+        return (
+            name,
+            getattr(game.kind, "value", game.kind),
+            game.host,
+            len(game.players),
+            game.instance is not None,
+            bool(game.instance and game.instance.check_win()),
+            modified,
+        )
+
+    def rebuild(self, games):
+        """one-time scan of all stored games, e.g. for an existing volume"""
+        self.update_many(
+            self.row(name, game, game.modified or mtime) for name, game, mtime in games
+        )
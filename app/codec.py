@@ -0,0 +1,330 @@
+"""Encoding of stored games.
+
+Every record carries its schema version; older records are migrated step
+by step on decode. Two formats:
+
+- json: orjson when installed, the stdlib json module otherwise
+- binary: struct packed, one byte per card
+
+decode() detects the format and returns a Game with its MauMau instance
+already built, so a store can switch formats and still read its old
+snapshots, including the unversioned default.json files.
+"""
+
+import json
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from typing import Optional, Tuple
+
+from .games.maumau import CARD_IDS, MauMau, Player
+from .models import Game, GameKind
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SCHEMA = 2
+MAGIC = b"CG"
+
+# binary layout, little endian: magic, schema, flags, modified,
+# journal offset, take cards, seed, reshuffles, version, number of game
+# players, number of hands, length of the string table
+FIXED = struct.Struct("<2sBBdQHIIIBBH")
+
+HAS_STATE = 1
+HAS_MODIFIED = 2
+HAS_OFFSET = 4
+HAS_HOST = 8
+# strings with a length prefix each; older records separate them with NUL,
+# which a player id from a cookie may contain
+HAS_LENGTHS = 16
+LENGTH = struct.Struct("<H")
+
+
+def dumps(obj) -> bytes:
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def loads(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def migrate_v1(data: dict) -> dict:
+    """unversioned records: card names, players as a dict, maybe no seed"""
+    state = data.get("state")
+    if state:
+
+        def ids(cards):
+            return [CARD_IDS[c] for c in cards]
+
+        state = {
+            "stack": ids(state["stack"]),
+            "playing_stack": ids(state["playing_stack"]),
+            "players": [
+                [p["id"], ids(p["cards"]), ids(p["in_flow"])]
+                for p in state["players"].values()
+            ],
+            "player_list": state["player_list"],
+            "current_player": state["current_player"],
+            "next_player_take_cards": state.get("next_player_take_cards") or 0,
+            # derived from the name, so every load reshuffles the same way
+            "seed": state.get("seed", zlib.crc32(data["name"].encode())),
+            "reshuffles": state.get("reshuffles", 0),
+            "version": state.get("version", 0),
+        }
+    return {
+        "schema": 2,
+        "name": data["name"],
+        "kind": data.get("kind", GameKind.maumau.value),
+        "host": data.get("host"),
+        "players": data.get("players", []),
+        "modified": data.get("modified"),
+        "journal_offset": data.get("journal_offset"),
+        "state": state,
+    }
+
+
+# schema version -> function returning the record in the next version
+MIGRATIONS = {
+    1: migrate_v1,
+}
+
+
+def migrate(record: dict) -> dict:
+    version = record.get("schema", 1)
+    if version > SCHEMA:
+        raise ValueError(f"record schema {version} is newer than {SCHEMA}")
+    while version < SCHEMA:
+        record = MIGRATIONS[version](record)
+        version += 1
+    return record
+
+
+def to_record(game: Game, journal_offset: Optional[int] = None) -> dict:
+    state = None
+    g = game.instance
+    if g:
+        state = {
+            "stack": list(g.stack),
+            "playing_stack": list(g.playing_stack),
+            "players": [
+                [p.id, list(p.cards), list(p.in_flow)] for p in g.players.values()
+            ],
+            "player_list": list(g.player_list),
+            "current_player": g.current_player,
+            "next_player_take_cards": g.next_player_take_cards,
+            "seed": g.seed,
+            "reshuffles": g.reshuffles,
+            "version": g.version,
+        }
+    return {
+        "schema": SCHEMA,
+        "name": game.name,
+        "kind": getattr(game.kind, "value", game.kind),
+        "host": game.host,
+        "players": list(game.players),
+        "modified": game.modified,
+        "journal_offset": journal_offset,
+        "state": state,
+    }
+
+
+def from_record(record: dict) -> Tuple[Game, Optional[int]]:
+    instance = None
+    state = record["state"]
+    if state:
+        instance = MauMau.from_state(
+            record["name"],
+            stack=state["stack"],
+            playing_stack=state["playing_stack"],
+            players=[Player(*p) for p in state["players"]],
+            player_list=state["player_list"],
+            current_player=state["current_player"],
+            next_player_take_cards=state["next_player_take_cards"],
+            seed=state["seed"],
+            reshuffles=state["reshuffles"],
+            version=state["version"],
+        )
+    game = Game(
+        name=record["name"],
+        players=record["players"],
+        kind=GameKind(record["kind"]),
+        host=record["host"],
+        instance=instance,
+        modified=record["modified"],
+    )
+    return game, record["journal_offset"]
+
+
+class Codec(ABC):
+    suffix = ""
+
+    def encode(self, game: Game, journal_offset: Optional[int] = None) -> bytes:
+        return self.encode_record(to_record(game, journal_offset))
+
+    @abstractmethod
+    def encode_record(self, record: dict) -> bytes:
+        """a record of to_record() in this format"""
+
+    @abstractmethod
+    def decode(self, data) -> Tuple[Game, Optional[int]]:
+        """the game and its journal offset"""
+
+
+class JSONCodec(Codec):
+    suffix = ".json"
+
+    def encode_record(self, record: dict) -> bytes:
+        return dumps(record)
+
+    def decode(self, data) -> Tuple[Game, Optional[int]]:
+        return from_record(migrate(loads(data)))
+
+
+class BinaryCodec(Codec):
+    """fixed size header, then the string table (each string after its
+    length), then per hand the index of its player id, the seating
+    order, the current player, the length of every card pile and the
+    card bytes"""
+
+    suffix = ".bin"
+
+    def encode_record(self, record: dict) -> bytes:
+        state = record["state"]
+        modified = record["modified"]
+        journal_offset = record["journal_offset"]
+        flags = (
+            (HAS_STATE if state else 0)
+            | (HAS_MODIFIED if modified is not None else 0)
+            | (HAS_OFFSET if journal_offset is not None else 0)
+            | (HAS_HOST if record["host"] is not None else 0)
+            | HAS_LENGTHS
+        )
+        players = record["players"]
+        strings = [record["name"], record["kind"], record["host"] or ""]
+        strings.extend(players)
+        hands = state["players"] if state else []
+        strings.extend(h[0] for h in hands if h[0] not in players)
+        table = bytearray()
+        for string in strings:
+            encoded = string.encode()
+            table += LENGTH.pack(len(encoded)) + encoded
+
+        out = bytearray(
+            FIXED.pack(
+                MAGIC,
+                SCHEMA,
+                flags,
+                modified or 0.0,
+                journal_offset or 0,
+                state["next_player_take_cards"] if state else 0,
+                state["seed"] if state else 0,
+                state["reshuffles"] if state else 0,
+                state["version"] if state else 0,
+                len(players),
+                len(hands),
+                len(table),
+            )
+        )
+        out += table
+        if state:
+            index = {s: i for i, s in enumerate(strings)}
+            piles = [state["stack"], state["playing_stack"]]
+            for _, cards, in_flow in hands:
+                piles.extend((cards, in_flow))
+            out += bytes(index[h[0]] for h in hands)
+            out += bytes(index[i] for i in state["player_list"])
+            out.append(index[state["current_player"]])
+            out += bytes(len(pile) for pile in piles)
+            for pile in piles:
+                out += bytes(pile)
+        return bytes(out)
+
+    def decode(self, data: bytes) -> Tuple[Game, Optional[int]]:
+        (
+            magic,
+            schema,
+            flags,
+            modified,
+            journal_offset,
+            take,
+            seed,
+            reshuffles,
+            version,
+            players,
+            hands,
+            size,
+        ) = FIXED.unpack_from(data)
+        if magic != MAGIC or schema != SCHEMA:
+            raise ValueError(f"not a binary record of schema {SCHEMA}")
+        pos = FIXED.size
+        if flags & HAS_LENGTHS:
+            strings = []
+            end = pos + size
+            while pos < end:
+                (n,) = LENGTH.unpack_from(data, pos)
+                strings.append(data[pos + 2 : pos + 2 + n].decode())
+                pos += 2 + n
+        else:
+            strings = data[pos : pos + size].decode().split("\0")
+            pos += size
+
+        instance = None
+        if flags & HAS_STATE:
+            ids = data[pos : pos + hands]
+            order = data[pos + hands : pos + 2 * hands]
+            current = data[pos + 2 * hands]
+            pos += 2 * hands + 1
+            lengths = data[pos : pos + 2 + 2 * hands]
+            pos += len(lengths)
+            piles = []
+            for n in lengths:
+                piles.append(array("B", data[pos : pos + n]))
+                pos += n
+            instance = MauMau.from_state(
+                strings[0],
+                stack=piles[0],
+                playing_stack=piles[1],
+                players=[
+                    Player(strings[i], piles[2 * k + 2], piles[2 * k + 3])
+                    for k, i in enumerate(ids)
+                ],
+                player_list=[strings[i] for i in order],
+                current_player=strings[current],
+                next_player_take_cards=take,
+                seed=seed,
+                reshuffles=reshuffles,
+                version=version,
+            )
+
+        game = Game(
+            name=strings[0],
+            players=strings[3 : 3 + players],
+            kind=GameKind(strings[1]),
+            host=strings[2] if flags & HAS_HOST else None,
+            instance=instance,
+            modified=modified if flags & HAS_MODIFIED else None,
+        )
+        return game, journal_offset if flags & HAS_OFFSET else None
+
+
+CODECS = {
+    "json": JSONCodec(),
+    "binary": BinaryCodec(),
+}
+
+
+def decode(data) -> Tuple[Game, Optional[int]]:
+    """decode a record in either format and any schema version"""
+    if isinstance(data, str):
+        data = data.encode()
+    if data[:2] == MAGIC:
+        return CODECS["binary"].decode(data)
+    return CODECS["json"].decode(data)
@@ -0,0 +1,217 @@
+"""Headless Mau-Mau games between bot policies.
+
+    python -m app.games.simulate --games 100000 --players 4 --policies random,greedy
+
+Batches of games run in a process pool; every game is seeded from the
+batch seed, so a run is reproducible for the same arguments.
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+from .bot import MonteCarloBot
+from .maumau import SEVEN, MauMau
+
+# a policy gets the game and its player id and returns (action, card)
+Policy = Callable[[MauMau, str], Tuple[str, object]]
+
+MAX_ACTIONS = 1000
+
+
+def choose(game: MauMau, player_id: str, pick) -> Tuple[str, object]:
+    cards = game.legal_cards(player_id)
+    if cards:
+        return "play_card", game.allowed_cards[pick(cards)]
+    if game.players[player_id].in_flow:
+        return "keep_card", None
+    return "take_card", None
+
+
+def random_policy(game: MauMau, player_id: str):
+    return choose(game, player_id, random.choice)
+
+
+def greedy_policy(game: MauMau, player_id: str):
+    """play the card of the suite held most, keep 7s for defence"""
+    suites = Counter(c >> 3 for c in game.players[player_id].cards)
+
+    def pick(cards):
+        return max(cards, key=lambda c: (c & 7 != SEVEN, suites[c >> 3]))
+
+    return choose(game, player_id, pick)
+
+
+def mcts_policy(game: MauMau, player_id: str):
+    """100 playouts per move, seeded from the game seed"""
+    bot = MonteCarloBot(playouts=100, seed=random.getrandbits(32))
+    return bot.choose(game, player_id)
+
+
+POLICIES: Dict[str, Policy] = {
+    "random": random_policy,
+    "greedy": greedy_policy,
+    "mcts": mcts_policy,
+}
+
+
+def play_game(seed: int, policies: List[str]) -> dict:
+    """one full game; players are p0..pN, pI plays policies[I]"""
+    random.seed(seed)
+    players = [f"p{i}" for i in range(len(policies))]
+    game = MauMau(f"sim-{seed}", list(players))
+    seats = {player_id: seat for seat, player_id in enumerate(game.player_list)}
+    bots = {player_id: POLICIES[name] for player_id, name in zip(players, policies)}
+
+    chains = []
+    actions = 0
+    winner = None
+    while actions < MAX_ACTIONS:
+        player_id = game.current_player
+        pending = game.next_player_take_cards
+        action, card = bots[player_id](game, player_id)
+        game.action(player_id, action, card)
+        actions += 1
+        if pending and not game.next_player_take_cards:
+            chains.append(pending // 2)
+        win = game.check_win()
+        if win:
+            winner = win["winner"]
+            break
+    return {
+        "winner": winner,
+        "seat": seats.get(winner),
+        "policy": policies[players.index(winner)] if winner else None,
+        "actions": actions,
+        "reshuffles": game.reshuffles,
+        "chains": chains,
+    }
+
+
+def new_stats() -> dict:
+    return {
+        "games": 0,
+        "unfinished": 0,
+        "actions": 0,
+        "reshuffles": 0,
+        "wins_by_seat": Counter(),
+        "wins_by_policy": Counter(),
+        "game_length": Counter(),
+        "reshuffle_count": Counter(),
+        "seven_chains": Counter(),
+    }
+
+
+def add_result(stats: dict, result: dict):
+    stats["games"] += 1
+    stats["actions"] += result["actions"]
+    stats["reshuffles"] += result["reshuffles"]
+    if result["winner"] is None:
+        stats["unfinished"] += 1
+    else:
+        stats["wins_by_seat"][result["seat"]] += 1
+        stats["wins_by_policy"][result["policy"]] += 1
+    # game length histogram in buckets of 10 actions
+    stats["game_length"][result["actions"] // 10 * 10] += 1
+    stats["reshuffle_count"][result["reshuffles"]] += 1
+    stats["seven_chains"].update(result["chains"])
+
+
+def merge(stats: dict, other: dict):
+    for key, value in other.items():
+        stats[key] += value
+
+
+def run_batch(args) -> dict:
+    seed, games, policies = args
+    stats = new_stats()
+    rng = random.Random(seed)
+    for _ in range(games):
+        add_result(stats, play_game(rng.getrandbits(64), policies))
+    return stats
+
+
+def summary(stats: dict, seconds: float) -> dict:
+    games = stats["games"] or 1
+    wins = sum(stats["wins_by_seat"].values()) or 1
+    return {
+        "games": stats["games"],
+        "seconds": round(seconds, 2),
+        "games_per_second": round(stats["games"] / seconds, 1) if seconds else None,
+        "unfinished": stats["unfinished"],
+        "win_rate_by_seat": {
+            k: round(v / wins, 4) for k, v in sorted(stats["wins_by_seat"].items())
+        },
+        "win_rate_by_policy": {
+            k: round(v / wins, 4) for k, v in sorted(stats["wins_by_policy"].items())
+        },
+        "mean_actions": round(stats["actions"] / games, 2),
+        "mean_reshuffles": round(stats["reshuffles"] / games, 4),
+        "game_length": dict(sorted(stats["game_length"].items())),
+        "reshuffle_count": dict(sorted(stats["reshuffle_count"].items())),
+        "seven_chains": dict(sorted(stats["seven_chains"].items())),
+    }
+
+
+def simulate(games, policies, workers=None, batch=1000, seed=0, progress=None):
+    """play `games` games in a process pool, returns the summary dict"""
+    batches = [
+        (seed * 1_000_003 + i, min(batch, games - i * batch), policies)
+        for i in range(-(-games // batch))
+    ]
+    stats = new_stats()
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(run_batch, batches):
+            merge(stats, result)
+            if progress:
+                progress(summary(stats, time.perf_counter() - start))
+    return summary(stats, time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=10000)
+    parser.add_argument("--players", type=int, default=2)
+    parser.add_argument(
+        "--policies",
+        default="random",
+        help="comma separated, cycled over the seats: " + ",".join(POLICIES),
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    names = args.policies.split(",")
+    policies = [names[i % len(names)] for i in range(args.players)]
+    for name in policies:
+        if name not in POLICIES:
+            parser.error(f"unknown policy: {name}")
+
+    def progress(s):
+        print(
+            f"{s['games']} games, {s['games_per_second']}/s, "
+            f"seats {s['win_rate_by_seat']}",
+            file=sys.stderr,
+        )
+
+    result = simulate(
+        args.games,
+        policies,
+        workers=args.workers,
+        batch=args.batch,
+        seed=args.seed,
+        progress=None if args.quiet else progress,
+    )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
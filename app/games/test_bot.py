@@ -0,0 +1,48 @@
+import random
+
+from .bot import MonteCarloBot, determinize
+from .maumau import MauMau
+
+
+def test_determinize():
+    random.seed(4)
+    g = MauMau("g1", ["p1", "p2", "p3"])
+    d = determinize(g, "p1", random.Random(1))
+    assert d.players["p1"].cards == g.players["p1"].cards
+    assert d.playing_stack == g.playing_stack
+    for player in ["p2", "p3"]:
+        assert len(d.players[player].cards) == len(g.players[player].cards)
+
+    def unseen(game):
+        cards = game.stack.tolist()
+        for player in ["p2", "p3"]:
+            cards.extend(game.players[player].cards)
+        return sorted(cards)
+
+    assert unseen(d) == unseen(g)
+    # the game itself is untouched
+    assert d.players["p2"].cards != g.players["p2"].cards
+
+
+def test_choose():
+    random.seed(5)
+    g = MauMau("g1", ["p1", "p2"])
+    before = g.serialize()
+    for _ in range(50):
+        if g.check_win():
+            break
+        player = g.current_player
+        move = MonteCarloBot(playouts=30, seed=1).choose(g, player)
+        assert move in g.legal_moves(player)
+        assert move == MonteCarloBot(playouts=30, seed=1).choose(g, player)
+        g.action(player, *move)
+    assert before != g.serialize()
+
+
+def test_budget():
+    random.seed(6)
+    g = MauMau("g1", ["p1", "p2"])
+    bot = MonteCarloBot(playouts=10**9, seconds=0.05)
+    bot.choose(g, g.current_player)
+    assert bot.stats["seconds"] < 1
+    assert bot.stats["playouts"] > 0 or len(g.legal_moves(g.current_player)) < 2
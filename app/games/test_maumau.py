@@ -2,7 +2,7 @@ import random
 
 import pytest
 
-from .maumau import MauMau
+from .maumau import CARDS, MauMau, card_names
 
 
 @pytest.fixture
@@ -107,8 +107,8 @@ def test_take_all_cards(default_game):
 def test_special_7a(default_game):
     g = default_game
     # check hand
-    assert g.players["p1"].cards == ["S-7", "C-8", "S-9", "C-A", "C-Q"]
-    assert g.players["p2"].cards == ["S-J", "H-7", "H-J", "D-9", "H-A"]
+    assert card_names(g.players["p1"].cards) == ["S-7", "C-8", "S-9", "C-A", "C-Q"]
+    assert card_names(g.players["p2"].cards) == ["S-J", "H-7", "H-J", "D-9", "H-A"]
 
     # play cards until ?-7 is possible
     g.action("p1", "play_card", "C-Q")
@@ -129,8 +129,8 @@ def test_special_7a(default_game):
 def test_special_7b(default_game):
     g = default_game
     # check hand
-    assert g.players["p1"].cards == ["S-7", "C-8", "S-9", "C-A", "C-Q"]
-    assert g.players["p2"].cards == ["S-J", "H-7", "H-J", "D-9", "H-A"]
+    assert card_names(g.players["p1"].cards) == ["S-7", "C-8", "S-9", "C-A", "C-Q"]
+    assert card_names(g.players["p2"].cards) == ["S-J", "H-7", "H-J", "D-9", "H-A"]
 
     # play cards until ?-7 is possible
     g.action("p1", "play_card", "C-Q")
@@ -167,15 +167,15 @@ def test_special_8(default_game):
     g = default_game
     g.current_player = "p1"
     # check hand
-    assert g.players["p1"].cards == ["S-7", "C-8", "S-9", "C-A", "C-Q"]
-    assert g.players["p2"].cards == ["S-J", "H-7", "H-J", "D-9", "H-A"]
+    assert card_names(g.players["p1"].cards) == ["S-7", "C-8", "S-9", "C-A", "C-Q"]
+    assert card_names(g.players["p2"].cards) == ["S-J", "H-7", "H-J", "D-9", "H-A"]
 
     assert g.status("p1").get("deck_top") == "D-K"
     # take cards until C-? is on top
     while True:
         c = next(g.pick_cards(1))
         g.playing_stack.extend([c])
-        if c[0] == "C":
+        if CARDS[c][0] == "C":
             break
     assert len(g.playing_stack) == 4
     assert g.status("p2").get("deck_top") == "C-J"
@@ -185,3 +185,75 @@ def test_special_8(default_game):
     g.action("p1", "play_card", "C-8")
     # p2 was deferred
     assert g.status("p1").get("your_turn")
+
+
+def test_version(default_game):
+    g = default_game
+    version = g.version
+    assert g.status("p1") is g.status("p1")
+    assert g.status() is g.status("unknown")
+
+    # rejected moves do not change the state
+    g.action("p1", "play_card", "C-Q")
+    g.action("p2", "play_card", "XX")
+    assert g.version == version
+
+    status = g.status("p2")
+    g.action("p2", "play_card", "D-9")
+    assert g.version > version
+    assert g.status("p2") is not status
+    assert g.status("p2")["deck_top"] == "D-9"
+
+
+def test_games_do_not_share_state(default_game):
+    players = ["p3", "p4", "p5"]
+    g = MauMau("g2", players)
+    assert list(default_game.players) == ["p1", "p2"]
+    assert sorted(g.players) == players
+    # the list passed in is not shuffled in place
+    assert players == ["p3", "p4", "p5"]
+    assert not hasattr(g, "__dict__")
+
+
+def test_clone(default_game):
+    g = default_game
+    c = g.clone()
+    assert c.serialize() == g.serialize()
+    c.action(c.current_player, "take_card")
+    assert c.serialize() != g.serialize()
+    assert c.journal and not g.journal
+    assert c.players["p1"].cards is not g.players["p1"].cards
+
+
+def test_journal_rejected(default_game):
+    g = default_game
+    # not the turn, not on the hand, not allowed on D-K
+    g.action("p1", "play_card", "C-Q")
+    g.action("p2", "play_card", "S-7")
+    g.action("p2", "play_card", "H-A")
+    assert g.journal == []
+    g.action("p2", "play_card", "D-9")
+    assert g.journal == [{"player_id": "p2", "action": "play_card", "card": "D-9"}]
+
+
+def test_legal_moves():
+    random.seed(3)
+    g = MauMau("g1", ["p1", "p2", "p3"])
+    for _ in range(200):
+        if g.check_win():
+            break
+        player = g.current_player
+        assert g.legal_moves(next(p for p in g.player_list if p != player)) == []
+        moves = g.legal_moves(player)
+        # a card is legal iff playing it puts it on the playing stack
+        hand = g.players[player].in_flow or g.players[player].cards
+        for card in card_names(hand):
+            played = g.clone()
+            played.action(player, "play_card", card)
+            on_top = CARDS[played.playing_stack[-1]] == card
+            assert (("play_card", card) in moves) == on_top
+        assert moves[-1][0] == (
+            "keep_card" if g.players[player].in_flow else "take_card"
+        )
+        g.action(player, *random.choice(moves))
+    assert g.check_win()
@@ -0,0 +1,14 @@
+from .simulate import play_game, run_batch, summary
+
+
+def test_play_game():
+    result = play_game(1, ["random", "greedy", "random"])
+    assert result["winner"] in ["p0", "p1", "p2"]
+    assert result == play_game(1, ["random", "greedy", "random"])
+
+
+def test_run_batch():
+    stats = run_batch((1, 50, ["random", "greedy"]))
+    s = summary(stats, 1.0)
+    assert s["games"] == 50
+    assert sum(stats["wins_by_seat"].values()) + s["unfinished"] == 50
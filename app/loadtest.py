@@ -0,0 +1,426 @@
+"""Load test with virtual players creating and playing games end to end.
+
+    python -m app.loadtest --games 500 --players 4 --rate 1
+    python -m app.loadtest --url http://127.0.0.1:8080 --games 500
+
+Without --url the app runs in this process and is called over ASGI, with
+a store in a temporary directory. With --url a running server is driven
+over the network; that needs the websockets package.
+
+Games are created through /new, /{name}/join and /{name}/start. Every
+player keeps /ws/{name}?protocol=json open, asks /{name}/moves after each
+broadcast and plays a random legal move through /{name}/action. The
+report has p50/p95/p99 latency per endpoint, the lag from an action to
+its broadcast arriving at the other players, and the errors.
+"""
+
+import argparse
+import asyncio
+import html
+import json
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote, urlsplit
+
+NAME = re.compile(r'<h3 class="is-size-3">([^<]+)</h3>')
+COOKIE = re.compile(r"user_id=([^;]+)")
+
+# a game that is not over after this many actions is stopped
+MAX_ACTIONS = 1000
+
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+class RequestFailed(Exception):
+    pass
+
+
+def percentiles(values: List[float]) -> dict:
+    """milliseconds"""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+    return {
+        "count": len(values),
+        "p50_ms": pick(0.5),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+
+class ASGIWebSocket:
+    """client side of a websocket to an app in this process"""
+
+    def __init__(self):
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.outbox: asyncio.Queue = asyncio.Queue()
+        self.accepted = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+        self.inbox.put_nowait({"type": "websocket.connect"})
+
+    async def receive_asgi(self):
+        return await self.inbox.get()
+
+    async def send_asgi(self, message):
+        if message["type"] == "websocket.accept":
+            self.accepted.set_result(True)
+        elif message["type"] == "websocket.send":
+            self.outbox.put_nowait(message.get("text"))
+        elif message["type"] == "websocket.close":
+            self.outbox.put_nowait(None)
+
+    async def recv(self) -> str:
+        text = await self.outbox.get()
+        if text is None:
+            raise ConnectionError("websocket closed")
+        return text
+
+    async def send(self, text: str):
+        self.inbox.put_nowait({"type": "websocket.receive", "text": text})
+
+    async def close(self):
+        self.inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        if self.task:
+            await self.task
+
+
+class ASGIClient:
+    """calls the app directly, without sockets or a server"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def scope(self, kind, path, cookie):
+        path, _, query = path.partition("?")
+        headers = [(b"host", b"loadtest")]
+        if cookie:
+            headers.append((b"cookie", f"user_id={cookie}".encode()))
+        return {
+            "type": kind,
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http" if kind == "http" else "ws",
+            "path": unquote(path),
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("loadtest", 80),
+            "subprotocols": [],
+        }
+
+    async def get(self, path: str, cookie: Optional[str] = None) -> Response:
+        response = {"status": 0, "headers": {}, "body": b""}
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if requested:
+                # only a streaming response waits for the disconnect
+                await asyncio.Event().wait()
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = {
+                    k.decode().lower(): v.decode() for k, v in message["headers"]
+                }
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+
+        await self.app(self.scope("http", path, cookie), receive, send)
+        return response["status"], response["headers"], response["body"]
+
+    async def websocket(self, path: str, cookie: Optional[str] = None):
+        ws = ASGIWebSocket()
+        ws.task = asyncio.create_task(
+            self.app(
+                self.scope("websocket", path, cookie), ws.receive_asgi, ws.send_asgi
+            )
+        )
+        await asyncio.wait([ws.accepted, ws.task], return_when=asyncio.FIRST_COMPLETED)
+        if not ws.accepted.done():
+            raise ConnectionError("websocket rejected")
+        return ws
+
+
+class NetClient:
+    """a running server; one connection per request"""
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.url = url.rstrip("/")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+
+    async def get(self, path: str, cookie: Optional[str] = None) -> Response:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            request = (
+                f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\nConnection: close\r\n"
+            )
+            if cookie:
+                request += f"Cookie: user_id={cookie}\r\n"
+            writer.write((request + "\r\n").encode())
+            head, _, body = (await reader.read()).partition(b"\r\n\r\n")
+        finally:
+            writer.close()
+        lines = head.decode("latin-1").split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return int(lines[0].split()[1]), headers, body
+
+    async def websocket(self, path: str, cookie: Optional[str] = None):
+        import websockets
+
+        return await websockets.connect(
+            "ws" + self.url[4:] + path, extra_headers={"Cookie": f"user_id={cookie}"}
+        )
+
+
+class Match:
+    """one game in play and what its players know about it"""
+
+    def __init__(self, name: str, players: List[str]):
+        self.name = name
+        self.players = players
+        self.winner: Optional[str] = None
+        self.actions = 0
+        # the player that acted last and when, to time the broadcast
+        self.actor: Optional[str] = None
+        self.acted = 0.0
+        self.wake = {player: asyncio.Event() for player in players}
+
+
+class LoadTest:
+    def __init__(self, client, players=3, rate=1.0, timeout=10.0, duration=None):
+        self.client = client
+        self.players = players
+        # seconds a player thinks before a move
+        self.think = 1 / rate if rate else 0
+        self.timeout = timeout
+        self.duration = duration
+        # no more moves after this time, games still running are unfinished
+        self.deadline = float("inf")
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.lag: List[float] = []
+        self.games: Counter = Counter()
+
+    async def get(self, label: str, path: str, cookie: Optional[str] = None):
+        start = time.perf_counter()
+        try:
+            status, headers, body = await asyncio.wait_for(
+                self.client.get(path, cookie), self.timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            self.errors[label] += 1
+            raise RequestFailed(f"{label}: {e!r}")
+        self.latency[label].append(time.perf_counter() - start)
+        if status >= 400:
+            self.errors[label] += 1
+            raise RequestFailed(f"{label}: HTTP {status}")
+        return headers, body
+
+    async def connect(self, name: str, player: str):
+        start = time.perf_counter()
+        try:
+            ws = await asyncio.wait_for(
+                self.client.websocket(f"/ws/{name}?protocol=json", player),
+                self.timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            self.errors["websocket"] += 1
+            raise RequestFailed(f"websocket: {e!r}")
+        self.latency["websocket"].append(time.perf_counter() - start)
+        return ws
+
+    async def create(self) -> Match:
+        headers, body = await self.get("new", "/new")
+        match = NAME.search(body.decode())
+        if not match:
+            raise RequestFailed("new: no game name")
+        # as used in urls
+        name = quote(html.unescape(match.group(1)))
+        players = [COOKIE.search(headers.get("set-cookie", "")).group(1)]
+        for _ in range(self.players - 1):
+            headers, _ = await self.get("join", f"/{name}/join")
+            players.append(COOKIE.search(headers.get("set-cookie", "")).group(1))
+        await self.get("start", f"/{name}/start", players[0])
+        return Match(name, players)
+
+    async def play_game(self):
+        sockets = []
+        listeners = []
+        try:
+            game = await self.create()
+            for player in game.players:
+                ws = await self.connect(game.name, player)
+                sockets.append(ws)
+                listeners.append(asyncio.create_task(self.listen(game, player, ws)))
+            await asyncio.gather(*(self.play(game, p) for p in game.players))
+            self.games["finished" if game.winner else "unfinished"] += 1
+        except (RequestFailed, ConnectionError, ValueError):
+            self.games["failed"] += 1
+        finally:
+            for task in listeners:
+                task.cancel()
+            for ws in sockets:
+                try:
+                    await ws.close()
+                except Exception:
+                    pass
+
+    async def listen(self, game: Match, player: str, ws):
+        """broadcasts to a player: time them and wake the player up"""
+        try:
+            while True:
+                event = json.loads(await ws.recv())
+                if event.get("event") != "status":
+                    continue
+                if game.actor and game.actor != player:
+                    self.lag.append(time.perf_counter() - game.acted)
+                game.wake[player].set()
+        except (ConnectionError, ValueError):
+            self.errors["websocket"] += 1
+        except Exception:
+            # the websockets package raises its own ConnectionClosed
+            pass
+
+    def running(self, game: Match) -> bool:
+        return (
+            game.winner is None
+            and game.actions < MAX_ACTIONS
+            and time.perf_counter() < self.deadline
+        )
+
+    async def play(self, game: Match, player: str):
+        while self.running(game):
+            game.wake[player].clear()
+            _, body = await self.get("moves", f"/{game.name}/moves", player)
+            data = json.loads(body)
+            if data.get("winner"):
+                game.winner = data["winner"]
+                break
+            if not data["moves"]:
+                try:
+                    # poll again if a broadcast got lost
+                    await asyncio.wait_for(game.wake[player].wait(), self.timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await asyncio.sleep(self.think * random.uniform(0.5, 1.5))
+            action, card = random.choice(data["moves"])
+            path = f"/{game.name}/action?action={action}"
+            if card:
+                path += f"&card={quote(card)}"
+            game.actor, game.acted = player, time.perf_counter()
+            game.actions += 1
+            await self.get("action", path, player)
+        # the other players may be waiting for a broadcast
+        for event in game.wake.values():
+            event.set()
+
+    async def run(self, games: int, concurrency: int) -> dict:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited():
+            async with semaphore:
+                await self.play_game()
+
+        start = time.perf_counter()
+        if self.duration:
+            self.deadline = start + self.duration
+        await asyncio.gather(*(limited() for _ in range(games)))
+        return self.report(time.perf_counter() - start)
+
+    def report(self, seconds: float) -> dict:
+        requests = sum(len(v) for v in self.latency.values()) + sum(
+            self.errors.values()
+        )
+        return {
+            "games": dict(self.games),
+            "seconds": round(seconds, 2),
+            "actions_per_second": round(len(self.latency["action"]) / seconds, 1),
+            "latency": {k: percentiles(v) for k, v in sorted(self.latency.items())},
+            "broadcast_lag": percentiles(self.lag),
+            "errors": dict(self.errors),
+            "error_rate": round(sum(self.errors.values()) / (requests or 1), 4),
+        }
+
+
+async def run_in_process(args) -> dict:
+    from . import main
+    from .store import Store
+
+    with tempfile.TemporaryDirectory() as path:
+        main.store = Store(
+            path=path, journal=True, write_behind=main.store.write_behind
+        )
+        await main.app.router.startup()
+        try:
+            test = LoadTest(
+                ASGIClient(main.app),
+                args.players,
+                args.rate,
+                args.timeout,
+                args.duration,
+            )
+            return await test.run(args.games, args.concurrency or args.games)
+        finally:
+            await main.app.router.shutdown()
+
+
+async def run_remote(args) -> dict:
+    test = LoadTest(
+        NetClient(args.url), args.players, args.rate, args.timeout, args.duration
+    )
+    return await test.run(args.games, args.concurrency or args.games)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="server to test, in this process if not set")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--players", type=int, default=3, help="per game, 2 to 6")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=1.0,
+        help="moves per second per player, 0 for no pause",
+    )
+    parser.add_argument("--concurrency", type=int, help="games at once, default all")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument(
+        "--duration", type=float, help="seconds until games are stopped unfinished"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    if not 2 <= args.players <= 6:
+        parser.error("--players must be between 2 and 6")
+
+    random.seed(args.seed)
+    result = asyncio.run(run_remote(args) if args.url else run_in_process(args))
+    print(json.dumps(result, indent=2))
+    if result["error_rate"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
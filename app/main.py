@@ -1,75 +1,238 @@
-import enum
-from dataclasses import dataclass
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Dict, Optional, Union
 
 from fastapi import (
     Cookie,
     FastAPI,
+    HTTPException,
     Query,
     Request,
     Response,
     WebSocket,
     WebSocketDisconnect,
 )
-from fastapi.responses import RedirectResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
+from .broker import Broker
+from .bundle import assets
+from .codec import loads
+from .games.bot import search
 from .games.maumau import MauMau
-from .names import new_name
-from .store import Store
-from .utils import WebsocketConnectionManager, create_user, gen_templates
+from .metrics import Registry
+from .models import Game, GameKind, GameStatus
+from .store import GameCache, Store
+from .utils import (
+    GameLocks,
+    WebsocketConnectionManager,
+    create_user,
+    gen_templates,
+    not_modified,
+    page_etag,
+    validators,
+)
+
+# CARDGAMES_LOG_LEVEL=DEBUG logs every save and the engine internals
+logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+logging.getLogger("app").setLevel(os.environ.get("CARDGAMES_LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
-store = Store()
+# with CARDGAMES_BROKER set to a unix socket path, several workers share
+# the store and relay websocket broadcasts through the socket
+BROKER = os.environ.get("CARDGAMES_BROKER")
+store = Store(
+    journal=True,
+    backend=os.environ.get("CARDGAMES_BACKEND", "filesystem"),
+    shared=bool(BROKER),
+    codec=os.environ.get("CARDGAMES_CODEC", "binary"),
+    # seconds between background writes, 0 writes before responding
+    write_behind=float(os.environ.get("CARDGAMES_WRITE_BEHIND", 0 if BROKER else 0.5)),
+    fsync=os.environ.get("CARDGAMES_FSYNC", "never"),
+)
 ws_manager = WebsocketConnectionManager()
+# budget per bot move
+BOT_PLAYOUTS = int(os.environ.get("CARDGAMES_BOT_PLAYOUTS", 2000))
+BOT_SECONDS = float(os.environ.get("CARDGAMES_BOT_SECONDS", 1))
+# searches run in processes, a thread would hold the GIL the event loop
+# needs; more searches at once wait for a free process
+BOT_WORKERS = int(
+    os.environ.get("CARDGAMES_BOT_WORKERS", max((os.cpu_count() or 1) - 1, 1))
+)
+bot_executor: Optional[ProcessPoolExecutor] = None
+# running bot task per game, until it is a human's turn again
+bot_tasks: Dict[str, asyncio.Task] = {}
+# searches in a row that may fail before the bots of a game wait for the
+# next load of it
+BOT_RETRIES = 3
+game_locks = GameLocks()
+# rendered status per game: (version, full html, {element id: html})
+status_cache = GameCache()
+# private view last pushed per game: {player: (hand, in flow, playable)}
+private_cache = GameCache()
+# rendered lobby pages and game pages for spectators
+page_cache = GameCache(maxsize=500, ttl=600)
 templates = gen_templates()
 
+metrics = Registry()
+action_seconds = metrics.histogram(
+    "cardgames_action_seconds", "time per stage of a game action", label="stage"
+)
+page_responses = metrics.counter(
+    "cardgames_page_responses_total",
+    "page views: not_modified, cached or rendered",
+    label="result",
+)
+
+
+@metrics.collector("cardgames_games_cached", "games in the store cache")
+def collect_games():
+    yield "cardgames_games_cached", {}, len(store.game_states)
 
-class GameKind(str, enum.Enum):
-    maumau: str = "maumau"
 
+@metrics.collector("cardgames_games_dirty", "saved games not written yet")
+def collect_dirty():
+    yield "cardgames_games_dirty", {}, len(store.dirty)
 
-@dataclass
-class Game:
-    name: str
-    players: List[str]
-    kind: GameKind
-    host: str
-    state: Optional[dict] = None
-    instance: Optional[Union[MauMau]] = None
-    modified: Optional[str] = None
 
-    def serialize(self):
-        return {k: v for k, v in self.__dict__.items() if k != "instance"}
+@metrics.collector("cardgames_cache_total", "store cache lookups", kind="counter")
+def collect_cache():
+    stats = store.game_states.stats()
+    for result in ["hits", "misses", "evictions"]:
+        yield "cardgames_cache_total", {"result": result}, stats[result]
 
 
-async def load_game(name: str):
-    _game = await store.load(name)
-    if _game:
-        if isinstance(_game, dict):
-            game = Game(**_game)
-            if game.state and not game.instance:
-                if game.kind == "maumau":
-                    print(f"create new game instance: {name}")
-                    g = MauMau(game.name, game.players)
-                    g.load(game.state)
-                    game.instance = g
-                    store.set(name, "instance", g)
-            return game
-        return _game
+@metrics.collector("cardgames_websockets", "open websockets per game")
+def collect_websockets():
+    for game, connections in ws_manager.active_connections.items():
+        yield "cardgames_websockets", {"game": game}, len(connections)
+
+
+@metrics.collector("cardgames_websocket_queued", "frames waiting to be sent per game")
+def collect_queued():
+    for game, connections in ws_manager.active_connections.items():
+        queued = sum(c.queue.qsize() for c in connections)
+        yield "cardgames_websocket_queued", {"game": game}, queued
+
+
+@metrics.collector("cardgames_sweep_total", "retention sweeper", kind="counter")
+def collect_sweeps():
+    for result, count in store.sweep_stats.items():
+        yield "cardgames_sweep_total", {"result": result}, count
+
+
+@metrics.collector(
+    "cardgames_lock_wait_seconds_total", "time spent waiting for game locks", "counter"
+)
+def collect_locks():
+    yield "cardgames_lock_wait_seconds_total", {}, game_locks.stats()["wait_total"]
+
+
+@metrics.collector("cardgames_names", "game names of the current format")
+def collect_names():
+    stats = store.names.remaining()
+    for key in ["capacity", "taken", "until_widening"]:
+        yield "cardgames_names", {"count": key}, stats[key]
+    yield "cardgames_names", {"count": "digits"}, stats["digits"]
+
+
+async def load_game(name: str) -> Optional[Game]:
+    game = await store.load(name)
+    if game and game.instance:
+        # also after a restart or a failed search
+        schedule_bot(name, game)
+    return game
+
+
+@app.on_event("startup")
+async def startup():
+    if BROKER:
+        ws_manager.broker = Broker(BROKER, ws_manager.deliver)
+        await ws_manager.broker.start()
+    day = 86400
+    store.start_sweeper(
+        interval=float(os.environ.get("CARDGAMES_SWEEP_INTERVAL", 3600)),
+        keep_snapshots=int(os.environ.get("CARDGAMES_KEEP_SNAPSHOTS", 3)),
+        archive_finished_after=float(os.environ.get("CARDGAMES_FINISHED_DAYS", 1))
+        * day,
+        archive_idle_after=float(os.environ.get("CARDGAMES_IDLE_DAYS", 30)) * day,
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if ws_manager.broker:
+        await ws_manager.broker.stop()
+    if bot_executor:
+        bot_executor.shutdown(wait=False)
+    await store.close()
 
 
 @app.get("/games")
-async def games(request: Request):
-    all_games = [i.name for i in await store.keys()]
-    active_games = {
-        k: store.get(k, "instance") is not None for k in store.game_states.keys()
-    }
-    return templates.TemplateResponse(
+async def games(
+    request: Request,
+    page: int = Query(1, ge=1),
+    status: Optional[GameStatus] = None,
+    recent: bool = True,
+):
+    per_page = 50
+    status = status.value if status else None
+    version = store.catalogue.version()
+    etag = page_etag("games", page, status, recent, version)
+    headers = validators(etag, version)
+    if not_modified(request.headers, etag, version):
+        page_responses.inc(label="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    # the lobby is the same for everybody
+    cached = page_cache.get(("games", page, status, recent))
+    if cached and cached[0] == etag:
+        page_responses.inc(label="cached")
+        return HTMLResponse(cached[1], headers=headers)
+
+    all_games = store.catalogue.query(
+        status=status, offset=(page - 1) * per_page, limit=per_page, recent=recent
+    )
+    pages = max(1, -(-store.catalogue.count(status) // per_page))
+    response = templates.TemplateResponse(
         "games.html",
-        {"request": request, "all_games": all_games, "active_games": active_games},
+        {
+            "request": request,
+            "all_games": all_games,
+            "page": page,
+            "pages": pages,
+            "status": status,
+            "recent": recent,
+        },
+        headers=headers,
+    )
+    page_cache.put(("games", page, status, recent), (etag, response.body))
+    page_responses.inc(label="rendered")
+    return response
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/build/{name}")
+async def build_asset(name: str, request: Request):
+    """sprite, stylesheet and scripts under content hashed names"""
+    result = assets().lookup(
+        name,
+        request.headers.get("accept-encoding", ""),
+        request.headers.get("if-none-match", ""),
     )
+    if result is None:
+        raise HTTPException(status_code=404, detail="not found")
+    status_code, headers, body = result
+    return Response(body, status_code=status_code, headers=headers)
 
 
 @app.get("/new/{kind}")
@@ -79,9 +242,9 @@ async def game_new(
     kind: Optional[GameKind] = Query(None),
     user_id: Union[str, None] = Cookie(default=None),
 ):
-    if not user_id:
+    if not user_id or is_bot(user_id):
         user_id = create_user()
-    name = new_name()
+    name = store.names.allocate()
     kind = kind if kind else GameKind.maumau
     game = Game(name=name, players=[user_id], kind=kind, host=user_id)
     await store.save(name, game)
@@ -106,35 +269,53 @@ async def game_start(
     request: Request,
     user_id: Union[str, None] = Cookie(default=None),
 ):
-    if not user_id:
+    if not user_id or is_bot(user_id):
         user_id = create_user()
-    game = await load_game(name)
     msg = ""
-    if game:
-        if game.instance:
-            return RedirectResponse(f"/{name}")
-        if user_id == game.host:
-            if len(game.players) < 2:
-                msg = "not enough players to start game"
-            else:
-                if game.kind == "maumau":
-                    game.instance = MauMau(game.name, game.players)
-                    await store.save(name, game)
+    async with game_locks.lock(name), store.lock(name):
+        game = await load_game(name)
+        if game:
+            if game.instance:
+                return RedirectResponse(f"/{name}")
+            if user_id == game.host:
+                if len(game.players) < 2:
+                    msg = "not enough players to start game"
                 else:
-                    msg = "only maumau supported atm"
+                    if game.kind == "maumau":
+                        game.instance = MauMau(game.name, game.players)
+                        await store.save(name, game)
+                        schedule_bot(name, game)
+                    else:
+                        msg = "only maumau supported atm"
 
-    response = templates.TemplateResponse(
-        "game_meta.html",
-        {
-            "request": request,
-            "user_id": user_id,
-            "name": name,
-            "msg": msg,
-            "game": game,
-        },
-    )
-    response.set_cookie(key="user_id", value=user_id)
-    return response
+    return game_meta(request, name, user_id, game, msg)
+
+
+@app.get("/{name}/add_bot")
+async def game_add_bot(
+    name: str,
+    request: Request,
+    user_id: Union[str, None] = Cookie(default=None),
+):
+    """the host adds a computer player before the start"""
+    if not user_id or is_bot(user_id):
+        user_id = create_user()
+    msg = ""
+    async with game_locks.lock(name), store.lock(name):
+        game = await load_game(name)
+        if game:
+            if game.instance:
+                return RedirectResponse(f"/{name}")
+            if user_id != game.host:
+                msg = "only the host can add bots"
+            elif len(game.players) > 5:
+                msg = "max players for this game is 5."
+            else:
+                bots = sum(is_bot(player) for player in game.players)
+                game.players.append(f"bot-{bots + 1}")
+                await store.save(name, game)
+
+    return game_meta(request, name, user_id, game, msg)
 
 
 @app.get("/{name}/join")
@@ -143,30 +324,45 @@ async def game_join(
     request: Request,
     user_id: Union[str, None] = Cookie(default=None),
 ):
-    if not user_id:
+    if not user_id or is_bot(user_id):
         user_id = create_user()
-    game = await load_game(name)
     msg = ""
-    if game:
-        if game.instance:
-            return RedirectResponse(f"/{name}")
-        elif len(game.players) > 5:
-            msg = "max players for this game is 5."
-        else:
-            if user_id not in game.players:
-                game.players.append(user_id)
-            await store.save(name, game)
+    async with game_locks.lock(name), store.lock(name):
+        game = await load_game(name)
+        if game:
+            if game.instance:
+                return RedirectResponse(f"/{name}")
+            elif len(game.players) > 5:
+                msg = "max players for this game is 5."
+            else:
+                if user_id not in game.players:
+                    game.players.append(user_id)
+                    await store.save(name, game)
 
-    response = templates.TemplateResponse(
-        "game_meta.html",
-        {
-            "request": request,
-            "user_id": user_id,
-            "name": name,
-            "msg": msg,
-            "game": game,
-        },
-    )
+    return game_meta(request, name, user_id, game, msg)
+
+
+def game_meta(request, name, user_id, game, msg):
+    """game_meta.html, or 304 if the viewer has this version of it"""
+    modified = game.modified if game else None
+    etag = page_etag("meta", name, modified, user_id, msg)
+    if game and not_modified(request.headers, etag, modified):
+        page_responses.inc(label="not_modified")
+        response = Response(status_code=304, headers=validators(etag, modified))
+    else:
+        page_responses.inc(label="rendered")
+        response = templates.TemplateResponse(
+            "game_meta.html",
+            {
+                "request": request,
+                "user_id": user_id,
+                "name": name,
+                "msg": msg,
+                "game": game,
+            },
+        )
+        if game:
+            response.headers.update(validators(etag, modified))
     response.set_cookie(key="user_id", value=user_id)
     return response
 
@@ -176,18 +372,181 @@ async def trigger_game_status(
     name: str,
     user_id: Union[str, None] = Cookie(default=None),
 ):
-    if not user_id:
+    if not user_id or is_bot(user_id):
         user_id = create_user()
-    await ws_manager.broadcast(await status_html(name, user_id), name)
+    await broadcast_status(name)
     return ""
 
 
-async def status_html(name, user_id):
+async def broadcast_status(name):
     game = await load_game(name)
     if game and game.instance:
-        template = templates.env.get_template("partials/status.html")
-        return template.render(state=game.instance.status(user_id))
-    return ""
+        version = game.instance.version
+        if ws_manager.is_current(name, version):
+            return
+        previous = status_cache.get(name)
+        full, fragments = status_html(name, game)
+        delta = base = None
+        if previous and previous[0] != version:
+            # only the elements that changed since the last broadcast
+            base = previous[0]
+            delta = "".join(
+                html for id, html in fragments.items() if previous[2].get(id) != html
+            )
+        await ws_manager.broadcast(full, name, version, delta=delta, base=base)
+
+
+def status_html(name, game):
+    """public status partial and its swappable elements, rendered once per
+    state version"""
+    version = game.instance.version
+    cached = status_cache.get(name)
+    if cached and cached[0] == version:
+        return cached[1], cached[2]
+    state = game.instance.status()
+    full = templates.env.get_template("partials/status.html").render(state=state)
+    macros = templates.env.get_template("partials/status_fragments.html").module
+    fragments = {"top-card": str(macros.top_card(state))}
+    for i, player in enumerate(state["players"]):
+        fragments[f"player-{i}"] = str(macros.player_row(state, i, player))
+    fragments["winner"] = str(macros.winner(state))
+    status_cache.put(name, (version, full, fragments))
+    return full, fragments
+
+
+@app.get("/{name}/history")
+async def game_history(
+    name: str,
+    start: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """accepted moves of a game, paged by position"""
+    # the catalogue is written on flush, the names on save
+    if name not in store.names and name not in store.catalogue:
+        raise HTTPException(status_code=404, detail="game not found")
+    return await store.history(name, start, limit)
+
+
+async def apply_action(name, user_id, action=None, card=None):
+    """apply an action of a player, if any; returns the state the player
+    sees, its version and the result, or None for a game not started"""
+    async with game_locks.lock(name), store.lock(name):
+        with action_seconds.time("load"):
+            game = await load_game(name)
+        if not (game and game.instance):
+            return None
+        r = {}
+        if action:
+            with action_seconds.time("action"):
+                r = game.instance.action(action=action, card=card, player_id=user_id)
+            with action_seconds.time("save"):
+                await store.save(name, game)
+            with action_seconds.time("broadcast"):
+                await broadcast_status(name)
+                await push_private(name, game, user_id)
+            schedule_bot(name, game)
+        return game.instance.status(user_id), game.instance.version, r
+
+
+def is_bot(player_id: Optional[str]) -> bool:
+    # user ids are uuids
+    return bool(player_id) and player_id.startswith("bot-")
+
+
+def schedule_bot(name, game):
+    """start the bots of a game whose turn it is, if not already running"""
+    instance = game.instance
+    if not is_bot(instance.current_player) or instance.check_win():
+        return
+    task = bot_tasks.get(name)
+    if task is None or task.done():
+        task = bot_tasks[name] = asyncio.create_task(bot_move(name))
+
+        def done(task):
+            if bot_tasks.get(name) is task:
+                del bot_tasks[name]
+
+        task.add_done_callback(done)
+
+
+def bot_pool() -> ProcessPoolExecutor:
+    """started on the first bot move"""
+    global bot_executor
+    if bot_executor is None:
+        # spawn: a fork would copy the event loop and the store threads
+        context = multiprocessing.get_context("spawn")
+        bot_executor = ProcessPoolExecutor(BOT_WORKERS, mp_context=context)
+    return bot_executor
+
+
+async def bot_move(name):
+    """bots search their moves on a copy of the game and apply them like
+    a player, until it is a human's turn"""
+    failures = 0
+    while failures < BOT_RETRIES:
+        game = await load_game(name)
+        if not (game and game.instance):
+            return
+        state = game.instance.clone()
+        player_id = state.current_player
+        if not is_bot(player_id) or state.check_win():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+            (action, card), stats = await loop.run_in_executor(
+                bot_pool(), search, state, player_id, BOT_PLAYOUTS, BOT_SECONDS
+            )
+            logger.debug("%s %s: %s %s, %s", name, player_id, action, card, stats)
+            result = await apply_action(name, player_id, action, card)
+            if result is None or result[1] == state.version:
+                raise RuntimeError(f"move not applied: {action} {card}")
+            failures = 0
+        except Exception:
+            failures += 1
+            logger.exception("bot move failed in %s (%d)", name, failures)
+            await asyncio.sleep(failures)
+
+
+async def push_private(name, game, actor):
+    """push the action area to every other player whose hand, drawn cards
+    or playable cards changed; the actor gets it as the response"""
+    seen = private_cache.get(name) or {}
+    current = {}
+    for player in game.players:
+        state = game.instance.status(player)
+        current[player] = key = (
+            tuple(state["your_deck"]),
+            tuple(state["your_in_flow"]),
+            tuple(state["your_playable"]),
+        )
+        if player == actor or seen.get(player) == key:
+            continue
+        if not ws_manager.broker and not ws_manager.is_connected(name, player):
+            continue
+        html = templates.get_template("partials/action_area.html").render(
+            user_id=player, state=state, name=name, msg=""
+        )
+        await ws_manager.push(f'<div id="action-area">{html}</div>', name, player)
+    private_cache.put(name, current)
+
+
+@app.get("/{name}/moves")
+async def game_moves(
+    name: str,
+    user_id: Union[str, None] = Cookie(default=None),
+):
+    """legal moves of the player, as (action, card) pairs"""
+    if is_bot(user_id):
+        user_id = None
+    game = await load_game(name)
+    if not (game and game.instance):
+        raise HTTPException(status_code=404, detail="game not found or not started")
+    win = game.instance.check_win()
+    return {
+        "version": game.instance.version,
+        "moves": game.instance.legal_moves(user_id),
+        "winner": win["winner"] if win else None,
+    }
 
 
 @app.get("/{name}/action")
@@ -199,22 +558,20 @@ async def game_action(
     card: Union[str, None] = None,
     user_id: Union[str, None] = Cookie(default=None),
 ):
-    if not user_id:
+    if not user_id or is_bot(user_id):
         user_id = create_user()
-    game = await load_game(name)
-    if game and game.instance:
-        r = {}
-        if action:
-            r = game.instance.action(action=action, card=card, player_id=user_id)
-            await store.save(name, game)
-            await ws_manager.broadcast(await status_html(name, user_id), name)
+    result = await apply_action(name, user_id, action, card)
+    if result is None:
+        return
+    state, _, r = result
 
+    with action_seconds.time("render"):
         return templates.TemplateResponse(
             "partials/action_area.html",
             {
                 "request": request,
                 "user_id": user_id,
-                "state": game.instance.status(user_id),
+                "state": state,
                 "name": name,
                 "msg": r.get("msg", ""),
             },
@@ -228,36 +585,110 @@ async def game_index(
     response: Response,
     user_id: Union[str, None] = Cookie(default=None),
 ):
-    if not user_id:
+    if not user_id or is_bot(user_id):
         user_id = create_user()
+    modified = await store.modified(name)
+    etag = page_etag("game", name, modified, user_id)
+    headers = validators(etag, modified)
+    if modified is not None and not_modified(request.headers, etag, modified):
+        page_responses.inc(label="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    # spectators all get the same page: (modified, players, body)
+    cached = page_cache.get(("game", name))
+    if cached and cached[0] == modified and user_id not in cached[1]:
+        page_responses.inc(label="cached")
+        return HTMLResponse(cached[2], headers=headers)
+
     game = await load_game(name)
     if game:
         if game.instance:
-            await ws_manager.broadcast(await status_html(name, user_id), name)
-            return templates.TemplateResponse(
+            player = user_id if user_id in game.players else None
+            response = templates.TemplateResponse(
                 "game_state.html",
                 {
                     "request": request,
-                    "you": user_id,
-                    "state": game.instance.status(user_id),
+                    "you": player,
+                    "state": game.instance.status(player),
                     "name": name,
                 },
+                headers=validators(page_etag("game", name, game.modified, user_id)),
             )
+            if player is None:
+                page_cache.put(
+                    ("game", name), (game.modified, set(game.players), response.body)
+                )
+            page_responses.inc(label="rendered")
+            return response
         return "game not started, yet"
     return "game not found"
 
 
+WEBSOCKET_ACTIONS = ["status", "play_card", "take_card", "keep_card"]
+
+
+async def websocket_message(name, user_id, text) -> dict:
+    """json protocol on the websocket: `{"id": .., "action": .., "card": ..}`
+    with the actions of /{name}/action, or `status` to only get the state"""
+    try:
+        message = loads(text)
+        action = message.get("action")
+        card = message.get("card")
+    except (ValueError, AttributeError):
+        return {"error": "expected a json object"}
+    reply = {"id": message.get("id")}
+    if action not in WEBSOCKET_ACTIONS or not (card is None or isinstance(card, str)):
+        reply["error"] = (
+            f"action is one of {', '.join(WEBSOCKET_ACTIONS)}, card a string"
+        )
+        return reply
+    if action == "status":
+        action = None
+    elif not user_id:
+        reply["error"] = "no user_id cookie"
+        return reply
+    try:
+        result = await apply_action(name, user_id, action, card)
+    except Exception:
+        # one bad message must not close the connection
+        logger.exception("websocket message in %s failed", name)
+        reply["error"] = "internal error"
+        return reply
+    if result is None:
+        reply["error"] = "game not found or not started"
+        return reply
+    state, version, r = result
+    reply.update(version=version, msg=r.get("msg", ""), state=state)
+    return reply
+
+
 @app.websocket("/ws/{game}")
 async def websocket_endpoint(
     game: str,
     websocket: WebSocket,
+    protocol: str = Query("html", regex="^(html|json)$"),
 ):
-    await ws_manager.connect(websocket, game)
+    # players are identified by the cookie of the page or bot
+    user_id = websocket.cookies.get("user_id")
+    if is_bot(user_id):
+        user_id = None
+    # the current state right away, not only after the next move
+    full = version = None
+    current = await load_game(game)
+    if current and current.instance:
+        full, _ = status_html(game, current)
+        version = current.instance.version
+    connection = await ws_manager.connect(
+        websocket, game, protocol, user_id, full, version
+    )
     try:
         while True:
-            data = await websocket.receive_text()
-            await websocket.send_text(data)
+            text = await websocket.receive_text()
+            reply = await websocket_message(game, user_id, text)
+            await ws_manager.reply(connection, reply)
     except WebSocketDisconnect:
+        pass
+    finally:
         ws_manager.disconnect(websocket, game)
 
 
@@ -0,0 +1,133 @@
+"""Metrics in the Prometheus text format, without a client library.
+
+Histograms and counters are updated on the hot path; everything that is
+already counted elsewhere (cache stats, open websockets) is read by a
+collector when /metrics is scraped.
+"""
+
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# seconds, from a cached status render to a slow disk write
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+# (name, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def format_value(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(value)
+
+
+class Histogram:
+    def __init__(
+        self, name: str, help: str, label: Optional[str] = None, buckets=BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        # per label value: counts per bucket (+Inf last), sum
+        self.counts: Dict[Optional[str], List[int]] = {}
+        self.sums: Dict[Optional[str], float] = defaultdict(float)
+
+    def observe(self, value: float, label: Optional[str] = None):
+        counts = self.counts.get(label)
+        if counts is None:
+            counts = self.counts[label] = [0] * (len(self.buckets) + 1)
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[label] += value
+
+    @contextmanager
+    def time(self, label: Optional[str] = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, label)
+
+    def collect(self) -> Iterable[Sample]:
+        for label, counts in self.counts.items():
+            labels = {self.label: label} if self.label else {}
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", dict(labels, le=le), total
+            yield f"{self.name}_sum", labels, self.sums[label]
+            yield f"{self.name}_count", labels, total
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values: Dict[Optional[str], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, label: Optional[str] = None):
+        self.values[label] += amount
+
+    def collect(self) -> Iterable[Sample]:
+        for label, value in self.values.items():
+            yield self.name, {self.label: label} if self.label else {}, value
+
+
+class Collector:
+    """metric read at scrape time from a function returning samples"""
+
+    def __init__(self, name: str, help: str, kind: str, func: Callable):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.func = func
+
+    def collect(self) -> Iterable[Sample]:
+        return self.func()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def collector(self, name, help, kind="gauge"):
+        """decorator for a function returning samples"""
+
+        def decorator(func):
+            self.register(Collector(name, help, kind, func))
+            return func
+
+        return decorator
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            kind = getattr(metric, "kind", type(metric).__name__.lower())
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            for name, labels, value in metric.collect():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
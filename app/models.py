@@ -0,0 +1,25 @@
+import enum
+from dataclasses import dataclass
+from typing import List, Optional, Union
+
+from .games.maumau import MauMau
+
+
+class GameKind(str, enum.Enum):
+    maumau: str = "maumau"
+
+
+class GameStatus(str, enum.Enum):
+    open: str = "open"
+    started: str = "started"
+    finished: str = "finished"
+
+
+@dataclass
+class Game:
+    name: str
+    players: List[str]
+    kind: GameKind
+    host: str
+    instance: Optional[Union[MauMau]] = None
+    modified: Optional[float] = None
@@ -1,8 +1,9 @@
 import json
+import math
 import random
 from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, Iterable, List, Optional
 
 
 @lru_cache(maxsize=10000)
@@ -14,12 +15,86 @@ def load(name) -> List[str]:
 ANIMALS = load("animals")
 COLORS = load("colors")
 
+# numbers 1..10**DIGITS at first
+DIGITS = 3
+# widen the numbers when this share of the names is taken, so a random
+# pick is free with a chance of at least 1 - MAX_LOAD
+MAX_LOAD = 0.5
 
-def new_name() -> str:
+
+def new_name(digits: int = DIGITS) -> str:
     return (
         random.choice(COLORS)
         + "-"
         + random.choice(ANIMALS)
         + "-"
-        + str(random.randint(1, 1000))
+        + str(random.randint(1, 10**digits))
     )
+
+
+def capacity(digits: int) -> int:
+    """number of names with numbers up to 10**digits"""
+    return len(COLORS) * len(ANIMALS) * 10**digits
+
+
+class NameAllocator:
+    """Unique game names from a set of the taken ones.
+
+    The set is loaded once, e.g. from the catalogue, and every saved or
+    allocated name is added; a check is a set lookup. Names of other
+    processes are only known to `exists`, which is asked about a name
+    before it is handed out.
+    """
+
+    def __init__(
+        self,
+        taken: Iterable[str] = (),
+        exists: Optional[Callable[[str], bool]] = None,
+        max_load: float = MAX_LOAD,
+    ):
+        self.taken = set(taken)
+        self.exists = exists
+        self.max_load = max_load
+        self.digits = DIGITS
+        self.widen()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.taken
+
+    def __len__(self) -> int:
+        return len(self.taken)
+
+    def widen(self):
+        # every shorter name is also one of the wider format
+        while len(self.taken) >= self.max_load * capacity(self.digits):
+            self.digits += 1
+
+    def add(self, name: str):
+        if name not in self.taken:
+            self.taken.add(name)
+            self.widen()
+
+    def allocate(self) -> str:
+        """a name neither taken nor known to `exists`; it is taken then"""
+        while True:
+            name = new_name(self.digits)
+            if name in self.taken:
+                continue
+            if self.exists and self.exists(name):
+                self.add(name)
+                continue
+            self.add(name)
+            return name
+
+    def remaining(self) -> Dict[str, int]:
+        """free names in the current format, before it is widened"""
+        total = capacity(self.digits)
+        return {
+            "digits": self.digits,
+            "capacity": total,
+            "taken": len(self.taken),
+            "remaining": total - len(self.taken),
+            "until_widening": max(
+                math.ceil(self.max_load * total) - len(self.taken), 0
+            ),
+        }
@@ -1,66 +1,435 @@
+import asyncio
 import datetime
-import json
+import fcntl
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import Dict, Optional, Set
 
-import aiofiles
+from .backends import BACKENDS, read_archive, write_archive
+from .catalogue import Catalogue
+from .codec import CODECS, decode, to_record
+from .names import NameAllocator
+
+logger = logging.getLogger(__name__)
+
+
+class GameCache:
+    """LRU cache of loaded games, bounded by size and idle time (seconds)"""
+
+    def __init__(self, maxsize=1000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.last_access = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return self.data.keys()
+
+    def get(self, name, default=None):
+        return self.data.get(name, default)
+
+    def lookup(self, name):
+        """get with hit/miss accounting, marks the game as recently used"""
+        if name in self.data:
+            self.hits += 1
+            self.data.move_to_end(name)
+            self.last_access[name] = time.monotonic()
+            return self.data[name]
+        self.misses += 1
+
+    def put(self, name, game):
+        """add a game and return the evicted (name, game) pairs"""
+        self.data[name] = game
+        self.data.move_to_end(name)
+        self.last_access[name] = time.monotonic()
+        return self.expire()
+
+    def expire(self):
+        evicted = []
+        deadline = time.monotonic() - self.ttl
+        while self.data:
+            name = next(iter(self.data))
+            if len(self.data) <= self.maxsize and self.last_access[name] > deadline:
+                break
+            evicted.append((name, self.data.pop(name)))
+            del self.last_access[name]
+        self.evictions += len(evicted)
+        return evicted
+
+    def stats(self):
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
 
 
 class Store:
-    def __init__(self):
-        self.path = Path("/data/store")
-        if not (self.path.exists() and self.path.is_dir()):
+    def __init__(
+        self,
+        path=None,
+        journal=False,
+        snapshot_every=50,
+        cache_size=1000,
+        cache_ttl=3600,
+        backend="filesystem",
+        shared=False,
+        codec="binary",
+        write_behind=0.0,
+        fsync="never",
+    ):
+        self.path = Path(path or "/data/store")
+        if not path and not (self.path.exists() and self.path.is_dir()):
             # local setup
             self.path = Path(__file__).parent / "data"
 
-        self.game_states = {}
+        # journal mode: append actions to journal.jsonl and only write a
+        # full snapshot every `snapshot_every` entries
+        self.journal = journal
+        self.snapshot_every = snapshot_every
+        # entries since the last snapshot, per game known to be stored
+        self.journal_length = {}
+
+        self.game_states = GameCache(maxsize=cache_size, ttl=cache_ttl)
+        self.backend = BACKENDS[backend](self.path, fsync=fsync)
+        # format of new snapshots; every format is readable
+        self.codec = CODECS[codec]
+        # backend calls block; they run one after another in this thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+
+        # shared: other processes write to the same backend, so cached
+        # games are checked against the backend stamp and actions take
+        # a file lock
+        self.shared = shared
+        self.stamps = {}
 
-    async def keys(self):
-        return self.path.glob("*")
+        # write-behind: save() only marks the game dirty, a background
+        # task writes all dirty games every `write_behind` seconds
+        if shared and write_behind:
+            raise ValueError("write-behind needs a store that is not shared")
+        self.write_behind = write_behind
+        self.dirty = {}
+        self.flusher: Optional[asyncio.Task] = None
+        self.flush_lock: Optional[asyncio.Lock] = None
+        self.loading: Dict[str, asyncio.Future] = {}
+
+        # retention: archived games are one compressed file each and are
+        # restored on load
+        self.archive_path = self.path / ".archive"
+        self.sweeper: Optional[asyncio.Task] = None
+        self.last_sweep = 0.0
+        self.sweep_stats = {"pruned": 0, "archived": 0, "restored": 0}
+
+        self.catalogue = Catalogue(self.path / "catalogue.sqlite3")
+        if not len(self.catalogue):
+            self.catalogue.rebuild(
+                (name, decode(data)[0], mtime)
+                for name, data, mtime in self.backend.scan()
+            )
+        # names of all stored games, for new ones; other workers only
+        # write to the catalogue
+        self.names = NameAllocator(
+            self.catalogue.names(),
+            exists=self.catalogue.__contains__ if shared else None,
+        )
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
 
     async def save(self, name, game):
-        print(f"save {name}")
+        logger.debug("save %s", name)
         ts = datetime.datetime.utcnow().timestamp()
         game.modified = ts
-        self.game_states[name] = game
+        self.names.add(name)
+        if game.instance:
+            for entry in game.instance.journal:
+                entry.setdefault("ts", ts)
+        self.dirty[name] = game
+        await self.cache(name, game)
+
+        if not self.write_behind:
+            await self.flush()
+        elif self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_regularly())
 
-        g = game.serialize()
-        # save serialized state, not instance
+    async def cache(self, name, game):
+        for _name, _game in self.game_states.put(name, game):
+            # evicted games are reloaded from disk, make sure nothing is lost
+            if getattr(_game, "instance", None) and _game.instance.journal:
+                self.dirty.setdefault(_name, _game)
+
+    async def flush(self):
+        """write all dirty games in one batch; several saves of a game
+        since the last flush become one write"""
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            if not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, {}
+            jobs = [self.prepare(name, game) for name, game in dirty.items()]
+            rows = [
+                self.catalogue.row(name, game, game.modified)
+                for name, game in dirty.items()
+            ]
+            journaled: Set[str] = set()
+            try:
+                stamps = await self.run(self.write, jobs, rows, journaled)
+            except asyncio.CancelledError:
+                # the I/O thread finishes the batch
+                raise
+            except Exception:
+                # keep the changes for the next flush, a snapshot then
+                # covers the journal as far as it got
+                for (name, entries, _), game in zip(jobs, dirty.values()):
+                    if game.instance and name not in journaled:
+                        game.instance.journal[:0] = entries
+                    self.dirty.setdefault(name, game)
+                    self.journal_length.pop(name, None)
+                raise
+            self.stamps.update(stamps)
+
+    async def flush_regularly(self):
+        while True:
+            await asyncio.sleep(self.write_behind)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("flush failed, retrying")
+
+    async def close(self):
+        """stop the background tasks and write what is left, e.g. on shutdown"""
+        if self.sweeper:
+            self.sweeper.cancel()
+            self.sweeper = None
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+
+    def start_sweeper(self, interval=3600, **policy):
+        self.sweeper = asyncio.create_task(self.sweep_regularly(interval, **policy))
+
+    async def sweep_regularly(self, interval, **policy):
+        while True:
+            try:
+                stats = await self.sweep(**policy)
+                logger.info("sweep: %s", stats)
+            except Exception:
+                logger.exception("sweep failed")
+            await asyncio.sleep(interval)
+
+    async def sweep(
+        self,
+        keep_snapshots=3,
+        archive_finished_after=86400,
+        archive_idle_after=30 * 86400,
+    ):
+        """delete old snapshots of the games saved since the last sweep,
+        and archive games finished or idle for the given seconds"""
+        now = time.time()
+        stats = {"pruned": 0, "archived": 0}
+        for name in self.catalogue.modified_since(self.last_sweep):
+            stats["pruned"] += await self.run(self.backend.prune, name, keep_snapshots)
+        self.last_sweep = now
+
+        for name in self.catalogue.archivable(
+            now - archive_finished_after, now - archive_idle_after
+        ):
+            async with self.lock(name):
+                # in use here; loads queued after the archive restore it
+                if name in self.game_states or name in self.dirty:
+                    continue
+                if name in self.loading:
+                    continue
+                if await self.run(self.archive, name):
+                    stats["archived"] += 1
+                    self.journal_length.pop(name, None)
+        for key, value in stats.items():
+            self.sweep_stats[key] += value
+        return stats
+
+    def archive(self, name):
+        """runs in the I/O thread"""
+        members = self.backend.dump(name)
+        if members is None:
+            return False
+        write_archive(self.archive_path / f"{name}.tar.gz", members)
+        self.backend.delete(name)
+        self.catalogue.set_archived(name)
+        return True
+
+    def restore(self, name):
+        """runs in the I/O thread"""
+        fn = self.archive_path / f"{name}.tar.gz"
+        if not fn.exists():
+            return False
+        self.backend.restore(name, read_archive(fn))
+        fn.unlink()
+        self.catalogue.set_archived(name, False)
+        self.sweep_stats["restored"] += 1
+        return True
+
+    def prepare(self, name, game):
+        """what to write for a game, taken on the event loop so actions
+        applied while the batch is written go into the next one"""
+        entries = []
         if game.instance:
-            g["state"] = game.instance.serialize()
-            g["instance"] = None
+            entries, game.instance.journal = game.instance.journal, []
+
+        snapshot = True
+        if self.journal and entries and name in self.journal_length:
+            count = self.journal_length[name] + len(entries)
+            self.journal_length[name] = count
+            snapshot = count >= self.snapshot_every
+        record = None
+        if snapshot:
+            # snapshot covers the journal up to here
+            self.journal_length[name] = 0
+            record = to_record(game)
+        return name, entries, record
+
+    def write(self, jobs, rows, journaled):
+        """runs in the I/O thread; adds the games whose journal entries
+        were written to `journaled`, also if a later write fails"""
+        for name, entries, record in jobs:
+            if self.journal and entries:
+                self.backend.append_journal(name, entries)
+                journaled.add(name)
+            if record is not None:
+                if self.journal:
+                    record["journal_offset"] = self.backend.journal_position(name)
+                self.backend.write_snapshot(
+                    name,
+                    self.codec.encode_record(record),
+                    record["modified"],
+                    compact=self.journal,
+                    suffix=self.codec.suffix,
+                )
+        self.catalogue.update_many(rows)
+        if self.shared:
+            return {name: self.backend.stamp(name) for name, _, _ in jobs}
+        return {}
+
+    def read(self, name):
+        """runs in the I/O thread"""
+        stamp = self.backend.stamp(name) if self.shared else None
+        data = self.backend.read_snapshot(name)
+        if not data and self.restore(name):
+            data = self.backend.read_snapshot(name)
+        if not data:
+            return None
+        game, offset = decode(data)
+        entries = []
+        if offset is not None:
+            entries = self.backend.read_journal(name, offset)
+        if entries and game.instance:
+            game.modified = entries[-1]["ts"]
+            for entry in entries:
+                entry.pop("ts", None)
+            game.instance.replay(entries)
+        return game, len(entries), stamp
+
+    async def modified(self, name):
+        """time of the last save of a game, without loading it"""
+        game = None
+        if not self.shared:
+            # other workers only update the catalogue
+            game = self.dirty.get(name) or self.game_states.get(name)
+        if game:
+            return game.modified
+        return self.catalogue.modified(name)
 
-        _path = self.path / name
-        _path.mkdir(exist_ok=True, parents=True)
+    async def history(self, name, start=0, limit=100):
+        """moves of a game from position start on, at most limit of them;
+        reads only the requested part of the journal"""
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        # entries taken by a running flush are on disk once it is done
+        async with self.flush_lock:
+            total, entries = await self.run(self.read_history, name, start, limit)
+            game = self.dirty.get(name) or self.game_states.get(name)
+            pending = game.instance.journal if game and game.instance else []
+        skip = max(start - total, 0)
+        entries.extend(pending[skip : skip + limit - len(entries)])
+        return {
+            "name": name,
+            "start": start,
+            "total": total + len(pending),
+            "moves": [
+                dict(entry, position=position)
+                for position, entry in enumerate(entries, start)
+            ],
+        }
 
-        fn = _path / f"{ts}.json"
-        async with aiofiles.open(fn, "w") as fp:
-            await fp.write(json.dumps(g))
-            # symlink to current version
-            _link = _path / "default.json"
-            _link.unlink(missing_ok=True)
-            _link.symlink_to(fn)
-        return
+    def read_history(self, name, start, limit):
+        """runs in the I/O thread"""
+        if not self.journal:
+            return 0, []
+        if self.backend.read_snapshot(name) is None:
+            self.restore(name)
+        return self.backend.history(name, start, limit)
 
     async def load(self, name):
-        if name in self.game_states:
-            print(f"local load: {name}")
-            return self.game_states.get(name)
-
-        fn = self.path / name / "default.json"
-        if fn.exists():
-            print(f"disc load: {name}")
-            async with aiofiles.open(fn, "r") as fp:
-                data = json.loads(await fp.read())
-                self.game_states[name] = data
-                return data
-        return
-
-    def set(self, name, attribute, value):
-        self.game_states[name][attribute] = value
-        return
-
-    def get(self, name, attribute):
-        if self.game_states.get(name) and hasattr(
-            self.game_states.get(name), attribute
-        ):
-            return getattr(self.game_states.get(name), attribute)
+        game = self.game_states.lookup(name) or self.dirty.get(name)
+        if game:
+            if not self.shared:
+                return game
+            if self.stamps.get(name) == await self.run(self.backend.stamp, name):
+                return game
+
+        # concurrent loads of a game share one read
+        task = self.loading.get(name)
+        if task is None:
+            task = self.loading[name] = asyncio.ensure_future(self.load_stored(name))
+            task.add_done_callback(lambda _: self.loading.pop(name, None))
+        return await asyncio.shield(task)
+
+    async def load_stored(self, name):
+        result = await self.run(self.read, name)
+        if result:
+            game, self.journal_length[name], stamp = result
+            if self.shared:
+                self.stamps[name] = stamp
+            await self.cache(name, game)
+            return game
+
+    @asynccontextmanager
+    async def lock(self, name):
+        """lock a game across processes, a no-op unless shared"""
+        if not self.shared:
+            yield
+            return
+        # a fixed number of lock files, picked by name
+        fn = self.path / ".locks" / str(zlib.crc32(name.encode()) % 64)
+        fn.parent.mkdir(exist_ok=True, parents=True)
+        with open(fn, "a") as fp:
+            while True:
+                try:
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(0.005)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
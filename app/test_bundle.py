@@ -0,0 +1,45 @@
+import gzip
+import xml.etree.ElementTree as ET
+
+from app.bundle import Assets, accepted
+
+
+def test_build(tmp_path):
+    assets = Assets(tmp_path)
+    name = assets.url("cards.svg").rsplit("/", 1)[1]
+    data = assets.assets[name].variants[""]
+    assert gzip.decompress(assets.assets[name].variants["gzip"]) == data
+
+    symbols = [e.get("id") for e in ET.fromstring(data) if e.tag.endswith("symbol")]
+    assert "white_h_7" in symbols
+    assert "back08" in symbols
+    ids = [e.get("id") for e in ET.fromstring(data).iter() if e.get("id")]
+    assert len(ids) == len(set(ids))
+
+    # unchanged sources are not built again
+    mtime = (tmp_path / "manifest.json").stat().st_mtime_ns
+    assert Assets(tmp_path).files == assets.files
+    assert (tmp_path / "manifest.json").stat().st_mtime_ns == mtime
+
+
+def test_lookup(tmp_path):
+    assets = Assets(tmp_path)
+    name = assets.url("ws.js").rsplit("/", 1)[1]
+
+    status, headers, body = assets.lookup(name, "gzip, deflate")
+    assert status == 200
+    assert headers["content-encoding"] == "gzip"
+    assert "immutable" in headers["cache-control"]
+    assert gzip.decompress(body) == (tmp_path / name).read_bytes()
+
+    status, headers, body = assets.lookup(name, "gzip;q=0")
+    assert "content-encoding" not in headers
+    assert body == (tmp_path / name).read_bytes()
+
+    status, _, body = assets.lookup(name, "", headers["etag"])
+    assert (status, body) == (304, b"")
+    assert assets.lookup("ws.0123456789ab.js") is None
+
+
+def test_accepted():
+    assert accepted("gzip, br;q=0, deflate;q=0.5") == ["gzip", "deflate"]
@@ -0,0 +1,18 @@
+import argparse
+import asyncio
+import random
+
+from app import main
+from app.loadtest import run_in_process
+
+
+def test_run_in_process(monkeypatch):
+    # run_in_process replaces the store of the app
+    monkeypatch.setattr(main, "store", main.store)
+    random.seed(1)
+    args = argparse.Namespace(
+        games=2, players=2, rate=0, timeout=10.0, duration=None, concurrency=None
+    )
+    result = asyncio.run(run_in_process(args))
+    assert result["error_rate"] == 0
+    assert result["games"] == {"finished": 2}
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import random
+import time
+from array import array
+
+import pytest
+from starlette.requests import Request
+
+from app import main
+from app.games.maumau import CARD_IDS, MauMau
+from app.models import Game, GameKind
+from app.store import Store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = Store(path=tmp_path, journal=True)
+    monkeypatch.setattr(main, "store", store)
+    return store
+
+
+def start_game(store, name="g1", players=("p1", "p2")):
+    random.seed(2)
+    game = Game(name=name, players=list(players), kind=GameKind.maumau, host="p1")
+    game.instance = MauMau(name, game.players)
+    asyncio.run(store.save(name, game))
+    return game
+
+
+def test_websocket_message(store):
+    game = start_game(store)
+    player = game.instance.current_player
+
+    async def send(message):
+        return await main.websocket_message("g1", player, json.dumps(message))
+
+    async def run():
+        for message in [
+            {"id": 1, "action": 5},
+            {"id": 2, "action": "play_card", "card": ["H-7"]},
+            {"id": 3, "action": "shuffle"},
+        ]:
+            reply = await send(message)
+            assert reply["id"] == message["id"] and "error" in reply
+        assert "error" in await main.websocket_message("g1", player, "[1]")
+        # a rejected move
+        reply = await send({"id": 4, "action": "play_card", "card": "X-1"})
+        assert reply["msg"].startswith("card is not on your hand")
+        reply = await send({"id": 5, "action": "status"})
+        version = reply["version"]
+        reply = await send({"id": 6, "action": "take_card"})
+        assert reply["version"] > version
+        await store.flush()
+
+    asyncio.run(run())
+    # only the accepted move is journaled, and the game still loads
+    journal = (store.path / "g1" / "journal.jsonl").read_text().splitlines()
+    assert [json.loads(line)["action"] for line in journal] == ["take_card"]
+    fresh = Store(path=store.path, journal=True)
+    loaded = asyncio.run(fresh.load("g1"))
+    assert loaded.instance.serialize() == game.instance.serialize()
+
+
+def test_play_hand_card_with_drawn_cards(store):
+    game = start_game(store)
+    g = game.instance
+    player = g.players[g.current_player]
+    # two drawn cards, and a card of the same suite on the hand
+    hand, drawn = [CARD_IDS["H-8"]], [CARD_IDS["H-9"], CARD_IDS["H-10"]]
+    for pile in [g.stack, g.playing_stack] + [
+        p for q in g.players.values() for p in (q.cards, q.in_flow)
+    ]:
+        pile[:] = array("B", [c for c in pile if c not in hand + drawn])
+    g.playing_stack.append(CARD_IDS["H-7"])
+    player.cards.extend(hand)
+    player.in_flow.extend(drawn)
+    asyncio.run(store.save("g1", game))
+
+    async def run():
+        reply = await main.websocket_message(
+            "g1", player.id, '{"action": "play_card", "card": "H-8"}'
+        )
+        assert reply["msg"].startswith("card is not one of the drawn cards")
+        assert reply["state"]["deck_top"] == "H-7"
+        await main.websocket_message(
+            "g1", player.id, '{"action": "play_card", "card": "H-9"}'
+        )
+        await store.flush()
+
+    asyncio.run(run())
+    assert g.playing_stack[-1] == CARD_IDS["H-9"]
+    fresh = Store(path=store.path, journal=True)
+    assert asyncio.run(fresh.load("g1")).instance.serialize() == g.serialize()
+
+
+def test_history(store):
+    store.write_behind = 60
+    game = start_game(store)
+    player = game.instance.current_player
+
+    async def run():
+        await main.apply_action("g1", player, "play_card", "X-1")
+        await main.apply_action("g1", player, "take_card")
+        # saved, not written to the catalogue yet
+        assert "g1" not in store.catalogue
+        page = await main.game_history("g1", 0, 100)
+        assert [m["action"] for m in page["moves"]] == ["take_card"]
+        with pytest.raises(main.HTTPException):
+            await main.game_history("g2", 0, 100)
+        await store.close()
+
+    asyncio.run(run())
+
+
+def test_bot_after_restart(store, monkeypatch):
+    monkeypatch.setattr(main, "BOT_PLAYOUTS", 20)
+    game = start_game(store, players=("p1", "bot-1"))
+    if game.instance.current_player == "p1":
+        game.instance.action("p1", "take_card")
+        asyncio.run(store.save("g1", game))
+    assert game.instance.current_player == "bot-1"
+    search = main.search
+    calls = []
+
+    def flaky(state, player_id, *budget):
+        calls.append(player_id)
+        if len(calls) == 1:
+            raise RuntimeError("search failed")
+        return search(state, player_id, *budget)
+
+    # in a thread, to count the calls
+    monkeypatch.setattr(main, "search", flaky)
+    monkeypatch.setattr(main, "bot_pool", lambda: None)
+
+    async def run():
+        # nobody moved since the restart; loading the game starts the bot
+        fresh = Store(path=store.path, journal=True)
+        monkeypatch.setattr(main, "store", fresh)
+        await main.load_game("g1")
+        await main.bot_tasks["g1"]
+        game = await main.load_game("g1")
+        assert game.instance.current_player == "p1" or game.instance.check_win()
+        assert "g1" not in main.bot_tasks
+
+    asyncio.run(run())
+    assert len(calls) >= 2
+
+
+def test_bot_search_off_the_loop():
+    random.seed(1)
+    game = MauMau("g1", ["bot-1", "bot-2"])
+
+    async def search():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            main.bot_pool(), main.search, game, game.current_player, None, 0.5
+        )
+
+    async def run():
+        # a warm pool, the first search starts the process
+        await search()
+        lag = []
+
+        async def ticker():
+            for _ in range(40):
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lag.append(time.perf_counter() - start - 0.01)
+
+        results = await asyncio.gather(search(), search(), ticker())
+        return results[:2], lag
+
+    try:
+        results, lag = asyncio.run(run())
+    finally:
+        main.bot_executor.shutdown()
+        main.bot_executor = None
+    assert all(move in game.legal_moves(game.current_player) for move, _ in results)
+    # in threads of this process the 90th percentile is 20 ms and more
+    lag.sort()
+    assert lag[len(lag) * 9 // 10] < 0.01
+
+
+def test_bot_cookie(store):
+    start_game(store, players=("p1", "bot-1"))
+    asyncio.run(store.save("g2", Game("g2", ["p1"], GameKind.maumau, "p1")))
+    request = Request({"type": "http", "method": "GET", "headers": []})
+
+    async def run():
+        # a bot id in the cookie is replaced, not seated
+        response = await main.game_join("g2", request, user_id="bot-1")
+        assert "bot-1" not in response.headers["set-cookie"]
+        assert (await main.load_game("g2")).players[1] != "bot-1"
+        moves = await main.game_moves("g1", user_id="bot-1")
+        assert moves["moves"] == []
+
+    asyncio.run(run())
@@ -0,0 +1,31 @@
+from app.metrics import Registry
+
+
+def test_render():
+    metrics = Registry()
+    seconds = metrics.histogram("t_seconds", "time", label="stage", buckets=(0.1, 1))
+    seconds.observe(0.05, "load")
+    seconds.observe(0.5, "load")
+    seconds.observe(5, "load")
+    hits = metrics.counter("t_hits_total", "hits")
+    hits.inc()
+
+    @metrics.collector("t_open", "open sockets")
+    def collect():
+        yield "t_open", {"game": 'a"b'}, 2
+
+    assert metrics.render().splitlines() == [
+        "# HELP t_seconds time",
+        "# TYPE t_seconds histogram",
+        't_seconds_bucket{stage="load",le="0.1"} 1',
+        't_seconds_bucket{stage="load",le="1"} 2',
+        't_seconds_bucket{stage="load",le="+Inf"} 3',
+        't_seconds_sum{stage="load"} 5.55',
+        't_seconds_count{stage="load"} 3',
+        "# HELP t_hits_total hits",
+        "# TYPE t_hits_total counter",
+        "t_hits_total 1.0",
+        "# HELP t_open open sockets",
+        "# TYPE t_open gauge",
+        't_open{game="a\\"b"} 2',
+    ]
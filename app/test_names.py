@@ -1,8 +1,35 @@
 import random
 
-from names import new_name
+from names import DIGITS, NameAllocator, new_name
 
 
 def test_new_name():
     random.seed(1)
     assert new_name() == "coffee-mosquito-868"
+
+
+def test_allocate():
+    random.seed(1)
+    names = NameAllocator(["coffee-mosquito-868"])
+    name = names.allocate()
+    assert name != "coffee-mosquito-868"
+    assert name in names and len(names) == 2
+
+
+def test_allocate_exists():
+    random.seed(1)
+    names = NameAllocator(exists=lambda name: name == "coffee-mosquito-868")
+    assert names.allocate() != "coffee-mosquito-868"
+    # names of other processes are remembered
+    assert "coffee-mosquito-868" in names
+
+
+def test_widen():
+    names = NameAllocator(max_load=1e-6)
+    assert names.digits == DIGITS
+    free = names.remaining()["until_widening"]
+    for i in range(free):
+        names.add(f"taken-{i}")
+    assert names.digits == DIGITS + 1
+    assert names.remaining()["taken"] == free
+    assert len(names.allocate().rsplit("-", 1)[1]) <= DIGITS + 2
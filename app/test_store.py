@@ -0,0 +1,235 @@
+import asyncio
+import json
+import random
+import time
+from functools import partial
+
+import pytest
+
+from app.games.maumau import MauMau
+from app.models import Game as _Game
+from app.store import Store
+
+Game = partial(_Game, kind="maumau", host="p1")
+
+
+def reload(store, name, **kwargs):
+    fresh = Store(path=store.path, journal=True, **kwargs)
+    return asyncio.run(fresh.load(name)).instance
+
+
+def test_journal_replay(tmp_path):
+    random.seed(2)
+    store = Store(path=tmp_path, journal=True, snapshot_every=3)
+    game = Game(name="g1", players=["p1", "p2"])
+    game.instance = MauMau("g1", game.players)
+    asyncio.run(store.save("g1", game))
+    game.instance = reload(store, "g1")
+
+    for player, card in [("p2", "D-9"), ("p1", "S-9"), ("p2", "S-J"), ("p1", "S-7")]:
+        game.instance.action(player, "play_card", card)
+        asyncio.run(store.save("g1", game))
+        assert reload(store, "g1").serialize() == game.instance.serialize()
+
+    # one snapshot, compacted after 3 entries, plus the journal and its index
+    files = sorted(i.name for i in (tmp_path / "g1").iterdir())
+    assert len(files) == 4
+    assert "journal.jsonl" in files
+    assert "journal.idx" in files
+    assert len((tmp_path / "g1" / "journal.jsonl").read_text().splitlines()) == 4
+
+
+def test_catalogue(tmp_path):
+    store = Store(path=tmp_path)
+    for name in ["g1", "g2", "g3"]:
+        asyncio.run(store.save(name, Game(name=name, players=["p1", "p2"])))
+    game = Game(name="g2", players=["p1", "p2"])
+    game.instance = MauMau("g2", game.players)
+    asyncio.run(store.save("g2", game))
+
+    assert [i["name"] for i in store.catalogue.query()] == ["g2", "g3", "g1"]
+    assert [i["name"] for i in store.catalogue.query(status="open")] == ["g3", "g1"]
+    assert store.catalogue.count("started") == 1
+
+    # a fresh catalogue is rebuilt from the directory tree once
+    (tmp_path / "catalogue.sqlite3").unlink()
+    assert Store(path=tmp_path).catalogue.count("started") == 1
+
+
+def test_cache_eviction(tmp_path):
+    store = Store(path=tmp_path, cache_size=2)
+    for name in ["g1", "g2", "g3"]:
+        asyncio.run(store.save(name, Game(name=name, players=["p1"])))
+    assert list(store.game_states.keys()) == ["g2", "g3"]
+
+    # evicted game comes back from disk
+    assert asyncio.run(store.load("g1")).name == "g1"
+    assert asyncio.run(store.load("g1")).name == "g1"
+    assert store.game_states.stats() == {
+        "size": 2,
+        "hits": 1,
+        "misses": 1,
+        "evictions": 2,
+    }
+
+    store.game_states.ttl = -1
+    assert len(store.game_states.expire()) == 2
+
+
+def test_shared_sqlite(tmp_path):
+    # two workers on one database, each with its own cache
+    random.seed(2)
+    a = Store(path=tmp_path, journal=True, backend="sqlite", shared=True)
+    b = Store(path=tmp_path, journal=True, backend="sqlite", shared=True)
+    game = Game(name="g1", players=["p1", "p2"])
+    game.instance = MauMau("g1", game.players)
+    asyncio.run(a.save("g1", game))
+    loaded = asyncio.run(b.load("g1"))
+    assert loaded.instance.serialize() == game.instance.serialize()
+
+    game.instance.action("p2", "play_card", "D-9")
+    asyncio.run(a.save("g1", game))
+    # b notices the journal entry written by a
+    loaded = asyncio.run(b.load("g1"))
+    assert loaded.instance.serialize() == game.instance.serialize()
+    assert b.catalogue.count("started") == 1
+
+
+def test_write_behind(tmp_path):
+    random.seed(2)
+    store = Store(path=tmp_path, journal=True, write_behind=60, cache_size=1)
+    game = Game(name="g1", players=["p1", "p2"])
+    game.instance = MauMau("g1", game.players)
+
+    async def run():
+        await store.save("g1", game)
+        await store.flush()
+        for player, card in [("p2", "D-9"), ("p1", "S-9")]:
+            game.instance.action(player, "play_card", card)
+            await store.save("g1", game)
+        # saved, but not written yet
+        assert not (tmp_path / "g1" / "journal.jsonl").exists()
+        # evicted while dirty, still loads the unwritten state
+        await store.save("g2", Game(name="g2", players=["p1"]))
+        assert await store.load("g1") is game
+        await store.close()
+
+    asyncio.run(run())
+    journal = (tmp_path / "g1" / "journal.jsonl").read_text().splitlines()
+    assert len(journal) == 2
+    assert reload(store, "g1").serialize() == game.instance.serialize()
+    assert store.catalogue.count() == 2
+
+
+@pytest.mark.parametrize("backend", ["filesystem", "sqlite"])
+def test_failed_snapshot(tmp_path, backend):
+    random.seed(2)
+    store = Store(path=tmp_path, journal=True, snapshot_every=2, backend=backend)
+    game = Game(name="g1", players=["p1", "p2"])
+    game.instance = MauMau("g1", game.players)
+    asyncio.run(store.save("g1", game))
+    write_snapshot = store.backend.write_snapshot
+
+    def fail(*args, **kwargs):
+        store.backend.write_snapshot = write_snapshot
+        raise OSError("disk full")
+
+    store.backend.write_snapshot = fail
+    game.instance.action("p2", "play_card", "D-9")
+    game.instance.action("p1", "play_card", "S-9")
+    # the journal is written, the snapshot after it fails
+    with pytest.raises(OSError):
+        asyncio.run(store.save("g1", game))
+    asyncio.run(store.flush())
+
+    page = asyncio.run(store.history("g1"))
+    assert [m["card"] for m in page["moves"]] == ["D-9", "S-9"]
+    assert reload(store, "g1", backend=backend).serialize() == game.instance.serialize()
+
+
+def test_prune_snapshots(tmp_path):
+    # without a journal every save leaves a snapshot
+    store = Store(path=tmp_path)
+    for i in range(5):
+        asyncio.run(store.save("g1", Game(name="g1", players=["p1"])))
+    assert len(list((tmp_path / "g1").glob("*.bin"))) == 5
+    assert asyncio.run(store.sweep(keep_snapshots=2))["pruned"] == 3
+    assert len(list((tmp_path / "g1").glob("*.bin"))) == 2
+    assert asyncio.run(store.sweep(keep_snapshots=2))["pruned"] == 0
+
+
+def test_prune_absolute_link(tmp_path):
+    # older versions linked default.json to the absolute path
+    _path = tmp_path / "g1"
+    _path.mkdir()
+    now = time.time()
+    for ts in [now - 2, now - 1, now]:
+        data = {"name": "g1", "players": ["p1"], "kind": "maumau", "modified": ts}
+        fn = _path / f"{ts}.json"
+        fn.write_text(json.dumps(data))
+    (_path / "default.json").symlink_to(fn)
+
+    store = Store(path=tmp_path)
+    assert asyncio.run(store.sweep(keep_snapshots=1))["pruned"] == 2
+    assert sorted(i.name for i in _path.iterdir()) == [fn.name, "default.json"]
+    assert asyncio.run(Store(path=tmp_path).load("g1")).modified == now
+
+
+@pytest.mark.parametrize("backend", ["filesystem", "sqlite"])
+def test_archive(tmp_path, backend):
+    random.seed(2)
+    store = Store(path=tmp_path, journal=True, backend=backend)
+    game = Game(name="g1", players=["p1", "p2"])
+    game.instance = MauMau("g1", game.players)
+    asyncio.run(store.save("g1", game))
+    game.instance.action("p2", "play_card", "D-9")
+    asyncio.run(store.save("g1", game))
+    asyncio.run(store.save("g2", Game(name="g2", players=["p1"])))
+
+    # idle games in use are kept
+    assert asyncio.run(store.sweep(archive_idle_after=-1))["archived"] == 0
+    store.game_states.data.clear()
+    assert asyncio.run(store.sweep(archive_idle_after=-1))["archived"] == 2
+    assert sorted(i.name for i in (tmp_path / ".archive").iterdir()) == [
+        "g1.tar.gz",
+        "g2.tar.gz",
+    ]
+    assert not store.backend.exists("g1")
+
+    # restored on load, including the journal after the snapshot
+    assert reload(store, "g1", backend=backend).serialize() == game.instance.serialize()
+    assert store.backend.exists("g1")
+    assert not (tmp_path / ".archive" / "g1.tar.gz").exists()
+    assert store.catalogue.archivable(0, time.time() + 1) == ["g1"]
+
+
+@pytest.mark.parametrize("backend", ["filesystem", "sqlite"])
+def test_history(tmp_path, backend):
+    random.seed(2)
+    moves = [("p2", "D-9"), ("p1", "S-9"), ("p2", "S-J"), ("p1", "S-7")]
+    store = Store(path=tmp_path, journal=True, snapshot_every=3, backend=backend)
+    game = Game(name="g1", players=["p1", "p2"])
+    game.instance = MauMau("g1", game.players)
+    asyncio.run(store.save("g1", game))
+    for player, card in moves[:3]:
+        game.instance.action(player, "play_card", card)
+        asyncio.run(store.save("g1", game))
+    if backend == "filesystem":
+        # journal written before the index existed
+        (tmp_path / "g1" / "journal.idx").write_bytes(b"")
+
+    page = asyncio.run(store.history("g1", start=1, limit=1))
+    assert page["total"] == 3
+    assert [(m["position"], m["player_id"], m["card"]) for m in page["moves"]] == [
+        (1, "p1", "S-9")
+    ]
+
+    # moves not written yet are included
+    store.write_behind = 60
+    game.instance.action("p1", "play_card", "S-7")
+    asyncio.run(store.save("g1", game))
+    page = asyncio.run(store.history("g1", start=2))
+    assert page["total"] == 4
+    assert [m["card"] for m in page["moves"]] == ["S-J", "S-7"]
+    assert all("ts" in m for m in page["moves"])
+    assert asyncio.run(store.history("g1", start=10))["moves"] == []
@@ -0,0 +1,171 @@
+import asyncio
+import json
+
+from app.utils import (
+    GameLocks,
+    WebsocketConnectionManager,
+    not_modified,
+    page_etag,
+    validators,
+)
+
+
+def test_game_locks():
+    locks = GameLocks()
+    order = []
+
+    async def act(game, i):
+        async with locks.lock(game):
+            order.append((game, i, "start"))
+            await asyncio.sleep(0.01)
+            order.append((game, i, "end"))
+
+    async def run():
+        await asyncio.gather(act("g1", 1), act("g1", 2), act("g2", 1))
+
+    asyncio.run(run())
+    g1 = [i for i in order if i[0] == "g1"]
+    assert [i[1:] for i in g1] == [(1, "start"), (1, "end"), (2, "start"), (2, "end")]
+    # g2 does not wait for g1
+    assert order.index(("g2", 1, "start")) < order.index(("g1", 1, "end"))
+
+    stats = locks.stats()
+    assert stats["games"] == 0
+    assert stats["max_depth"] == 2
+    assert stats["acquired"] == 3
+
+
+class FakeWebsocket:
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.received = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        if self.fail:
+            raise RuntimeError("broken pipe")
+        await asyncio.sleep(self.delay)
+        self.received.append(message)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_broadcast():
+    manager = WebsocketConnectionManager(queue_size=2, send_timeout=0.5)
+    fast, slow, broken = (
+        FakeWebsocket(),
+        FakeWebsocket(delay=0.05),
+        FakeWebsocket(fail=True),
+    )
+
+    async def run():
+        for ws in [fast, slow, broken]:
+            await manager.connect(ws, "g1")
+        for i in range(5):
+            await manager.broadcast(str(i), "g1")
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert fast.received == ["0", "1", "2", "3", "4"]
+    # stale frames of the slow client were dropped, the latest arrived
+    assert slow.received[-1] == "4"
+    assert len(slow.received) < 5
+    # the broken socket was pruned
+    assert broken.closed
+    assert [i.websocket for i in manager.active_connections["g1"]] == [fast, slow]
+
+
+def test_delta_frames():
+    manager = WebsocketConnectionManager()
+    first, second = FakeWebsocket(), FakeWebsocket()
+
+    async def run():
+        await manager.connect(first, "g1")
+        await manager.broadcast("full-1", "g1", 1)
+        await manager.broadcast("full-2", "g1", 2, delta="delta-2", base=1)
+        await asyncio.sleep(0.01)
+        # a new client gets the full frame, the others nothing
+        await manager.connect(second, "g1")
+        await manager.broadcast("full-2", "g1", 2, delta="delta-2", base=1)
+        await manager.broadcast("full-3", "g1", 3, delta="delta-3", base=2)
+        # a client that missed a version resyncs with the full frame
+        await manager.broadcast("full-5", "g1", 5, delta="delta-5", base=4)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert first.received == ["full-1", "delta-2", "delta-3", "full-5"]
+    assert second.received == ["full-2", "delta-3", "full-5"]
+
+
+def test_json_protocol():
+    manager = WebsocketConnectionManager()
+    bot = FakeWebsocket()
+
+    async def run():
+        connection = await manager.connect(bot, "g1", protocol="json")
+        await manager.broadcast("full-1", "g1", 1)
+        await asyncio.sleep(0.01)
+        await manager.reply(connection, {"id": 1, "version": 1})
+
+    asyncio.run(run())
+    assert [json.loads(i) for i in bot.received] == [
+        {"event": "status", "version": 1},
+        {"id": 1, "version": 1},
+    ]
+
+
+def test_connect_sends_state():
+    manager = WebsocketConnectionManager()
+    page, bot = FakeWebsocket(), FakeWebsocket()
+
+    async def run():
+        await manager.connect(page, "g1", full="full-3", version=3)
+        await manager.connect(bot, "g1", protocol="json", full="full-3", version=3)
+        await asyncio.sleep(0.01)
+        # both are up to date, the next broadcast of it is not sent again
+        await manager.broadcast("full-3", "g1", 3)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert page.received == ["full-3"]
+    assert [json.loads(i) for i in bot.received] == [{"event": "status", "version": 3}]
+
+
+def test_not_modified():
+    etag = page_etag("game", "g1", 1700000000.5, "p1")
+    assert etag != page_etag("game", "g1", 1700000000.5, "p2")
+    headers = validators(etag, 1700000000.5)
+    assert not_modified({"if-none-match": etag}, etag)
+    assert not_modified({"if-none-match": f'"other", {etag}'}, etag)
+    assert not not_modified({"if-none-match": '"other"'}, etag)
+    # If-Modified-Since only without If-None-Match
+    since = {"if-modified-since": headers["Last-Modified"]}
+    assert not_modified(since, etag, 1700000000.5)
+    assert not not_modified(since, etag, 1700000001.5)
+    assert not not_modified({"if-modified-since": "yesterday"}, etag, 1.0)
+    assert not not_modified({}, etag, 1.0)
+
+
+def test_push_to_player():
+    manager = WebsocketConnectionManager()
+    p1, p2, spectator = FakeWebsocket(), FakeWebsocket(), FakeWebsocket()
+
+    async def run():
+        await manager.connect(p1, "g1", user_id="p1")
+        await manager.connect(p2, "g1", user_id="p2")
+        await manager.connect(spectator, "g1")
+        assert manager.is_connected("g1", "p2")
+        await manager.push("hand of p2", "g1", "p2")
+        await manager.broadcast("status", "g1", 1)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert p1.received == ["status"]
+    assert p2.received == ["hand of p2", "status"]
+    assert spectator.received == ["status"]
@@ -1,38 +1,351 @@
+import asyncio
+import hashlib
+import json
+import time
 import uuid
 from collections import defaultdict
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional, Union
 
 from fastapi import WebSocket
 from fastapi.templating import Jinja2Templates
+from markupsafe import Markup
+
+from .bundle import assets
+
+
+class Frame:
+    """one state version: the full fragment, and the out-of-band swaps of
+    only the changed elements for clients that have the `base` version"""
+
+    __slots__ = ("version", "full", "delta", "base")
+
+    def __init__(
+        self,
+        version: Optional[int],
+        full: str,
+        delta: Optional[str] = None,
+        base: Optional[int] = None,
+    ):
+        self.version = version
+        self.full = full
+        self.delta = delta
+        self.base = base
+
+
+class Connection:
+    """websocket with a bounded queue of outgoing frames"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        maxsize: int,
+        protocol: str = "html",
+        user_id: Optional[str] = None,
+    ):
+        self.websocket = websocket
+        # owner of the socket, the only one that gets its private fragments
+        self.user_id = user_id
+        # html: htmx fragments; json: state versions and replies for bots
+        self.protocol = protocol
+        # replies to the client are sent between queued frames
+        self.lock = asyncio.Lock()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.closed = False
+        self.tasks: List[asyncio.Task] = []
+        # state version the client has, None until the first full frame
+        self.version: Optional[int] = None
+        self.bytes_sent = 0
+
+    def send(self, message: Union[Frame, str]):
+        if self.queue.full():
+            # a slow client only needs the latest state; missing a delta
+            # makes the next frame a full one
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    def render(self, frame: Frame) -> Optional[str]:
+        """text to send for a frame, None if the client is up to date"""
+        if frame.version is not None and frame.version == self.version:
+            return None
+        if self.protocol == "json":
+            self.version = frame.version
+            return json.dumps({"event": "status", "version": frame.version})
+        text = frame.full
+        if frame.delta is not None and self.version is not None:
+            if frame.base == self.version:
+                text = frame.delta
+        self.version = frame.version
+        return text or None
 
 
 class WebsocketConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[WebSocket] = defaultdict(list)
+    # an html comment does not swap anything in the htmx ws extension
+    heartbeat_message = "<!-- ping -->"
+    heartbeat_json = '{"event": "ping"}'
+
+    def __init__(self, queue_size=8, send_timeout=5.0, heartbeat=20.0):
+        self.active_connections: Dict[str, List[Connection]] = defaultdict(list)
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.heartbeat = heartbeat
+        # state version last sent per game
+        self.versions: Dict[str, int] = {}
+        # set to a Broker to reach clients connected to other workers
+        self.broker = None
 
-    async def connect(self, websocket: WebSocket, game: str):
+    async def connect(
+        self,
+        websocket: WebSocket,
+        game: str,
+        protocol: str = "html",
+        user_id: Optional[str] = None,
+        full: Optional[str] = None,
+        version: Optional[int] = None,
+    ) -> Connection:
+        """accept a client; `full` is the current state, queued as its
+        first frame"""
         await websocket.accept()
-        self.active_connections[game].append(websocket)
+        connection = Connection(websocket, self.queue_size, protocol, user_id)
+        self.active_connections[game].append(connection)
+        # the new client has not seen any version yet
+        self.versions.pop(game, None)
+        if full is not None:
+            connection.send(Frame(version, full))
+        connection.tasks = [
+            asyncio.create_task(self.sender(connection, game)),
+            asyncio.create_task(self.pinger(connection)),
+        ]
+        return connection
 
     def disconnect(self, websocket: WebSocket, game: str):
-        self.active_connections[game].remove(websocket)
+        connections = self.active_connections.get(game, [])
+        for connection in [i for i in connections if i.websocket is websocket]:
+            connections.remove(connection)
+            connection.closed = True
+            for task in connection.tasks:
+                if task is not asyncio.current_task():
+                    task.cancel()
+        if not connections:
+            self.active_connections.pop(game, None)
+            self.versions.pop(game, None)
+
+    def is_connected(self, game: str, user_id: str):
+        """the player has a page open on this worker"""
+        return any(
+            c.user_id == user_id and c.protocol == "html"
+            for c in self.active_connections.get(game, [])
+        )
+
+    def is_current(self, game: str, version: int):
+        """all clients of the game already got this version"""
+        return self.versions.get(game) == version
 
-    async def broadcast(self, message: str, game: str):
+    async def broadcast(
+        self,
+        message: str,
+        game: str,
+        version: Optional[int] = None,
+        delta: Optional[str] = None,
+        base: Optional[int] = None,
+    ):
+        """send `message` (the full fragment) to every client of the game;
+        clients at version `base` only get `delta`"""
+        await self.deliver(message, game, version, delta, base)
+        if self.broker:
+            await self.broker.publish(game, message, version, delta, base)
+
+    async def push(self, message: str, game: str, user_id: str):
+        """send a private fragment to the pages of one player only"""
+        await self.deliver(message, game, user_id=user_id)
+        if self.broker:
+            await self.broker.publish(game, message, user_id=user_id)
+
+    async def deliver(
+        self,
+        message: str,
+        game: str,
+        version: Optional[int] = None,
+        delta: Optional[str] = None,
+        base: Optional[int] = None,
+        user_id: Optional[str] = None,
+    ):
+        """send to the clients connected to this process"""
+        if user_id is not None:
+            for connection in self.active_connections.get(game, []):
+                if connection.user_id == user_id and connection.protocol == "html":
+                    connection.send(message)
+            return
+        if version is not None:
+            if self.is_current(game, version):
+                return
+            self.versions[game] = version
+        frame = Frame(version, message, delta, base)
         for connection in self.active_connections.get(game, []):
-            await connection.send_text(message)
+            connection.send(frame)
+
+    async def sender(self, connection: Connection, game: str):
+        try:
+            # wait_for may swallow a cancel that races with a finished send
+            while not connection.closed:
+                message = await connection.queue.get()
+                if isinstance(message, Frame):
+                    # delta or full frame, depending on what the client has
+                    message = connection.render(message)
+                    if message is None:
+                        continue
+                async with connection.lock:
+                    await asyncio.wait_for(
+                        connection.websocket.send_text(message), self.send_timeout
+                    )
+                connection.bytes_sent += len(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # broken or stalled peer
+            self.disconnect(connection.websocket, game)
+            try:
+                await connection.websocket.close()
+            except Exception:
+                pass
+
+    async def pinger(self, connection: Connection):
+        """regular frames to find half-open sockets; a failed send prunes them"""
+        message = self.heartbeat_message
+        if connection.protocol == "json":
+            message = self.heartbeat_json
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            if connection.queue.empty():
+                connection.send(message)
+
+    async def reply(self, connection: Connection, data: dict):
+        """answer a message of the client, never dropped like queued frames"""
+        message = json.dumps(data)
+        async with connection.lock:
+            await asyncio.wait_for(
+                connection.websocket.send_text(message), self.send_timeout
+            )
+        connection.bytes_sent += len(message)
+
+
+class GameLocks:
+    """One lock per game, so actions on a game are applied one after another"""
+
+    def __init__(self):
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.waiting: Dict[str, int] = defaultdict(int)
+        self.acquired = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @asynccontextmanager
+    async def lock(self, game: str):
+        lock = self.locks.setdefault(game, asyncio.Lock())
+        self.waiting[game] += 1
+        self.max_depth = max(self.max_depth, self.depth(game))
+        start = time.monotonic()
+        try:
+            await lock.acquire()
+        finally:
+            self.waiting[game] -= 1
+        waited = time.monotonic() - start
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        try:
+            yield
+        finally:
+            lock.release()
+            if not self.waiting[game]:
+                # nobody queued, forget the game
+                del self.waiting[game]
+                del self.locks[game]
+
+    def depth(self, game: str):
+        """requests waiting for or holding the game"""
+        lock = self.locks.get(game)
+        return self.waiting.get(game, 0) + (1 if lock and lock.locked() else 0)
+
+    def stats(self):
+        return {
+            "games": len(self.locks),
+            "waiting": sum(self.waiting.values()),
+            "max_depth": self.max_depth,
+            "acquired": self.acquired,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+        }
 
 
 def gen_templates():
     templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
 
-    def to_svg(value):
+    def card_symbol(value):
         value = value.replace("-", "_").lower()
-        return f"white_{value}.svg"
+        return f"white_{value}"
+
+    sprite = assets().url("cards.svg")
 
-    templates.env.filters["to_svg"] = to_svg
+    # every card is a symbol of one sprite, so any number of them is one
+    # request; the markup per card and size is built once
+    @lru_cache(maxsize=None)
+    def card_svg(symbol, width):
+        height = round(width * 190 / 140)
+        return Markup(
+            f'<svg class="card" width="{width}" height="{height}" '
+            f'viewBox="0 0 140 190"><use href="{sprite}#{symbol}"/></svg>'
+        )
+
+    def card_image(card, width=100):
+        return card_svg(card_symbol(card), width)
+
+    @lru_cache(maxsize=None)
+    def card_backs(count, width=25):
+        """a hand seen from the other players"""
+        return Markup("\n".join([card_svg("back08", width)] * count))
+
+    # content hashed url of a built asset, see bundle.py
+    templates.env.globals["asset_url"] = assets().url
+    templates.env.globals["card_image"] = card_image
+    templates.env.globals["card_backs"] = card_backs
     return templates
 
 
+def page_etag(*parts) -> str:
+    """weak validator of a rendered page, from everything it depends on"""
+    return 'W/"%s"' % hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+
+def validators(etag: str, modified: Optional[float] = None) -> Dict[str, str]:
+    # no-cache: browsers keep the page, but ask every time
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if modified:
+        headers["Last-Modified"] = formatdate(modified, usegmt=True)
+    return headers
+
+
+def not_modified(headers, etag: str, modified: Optional[float] = None) -> bool:
+    """the client has the page: If-None-Match, or else If-Modified-Since"""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since and modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(modified) <= since
+    return False
+
+
 def create_user():
     return str(uuid.uuid4())